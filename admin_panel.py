@@ -0,0 +1,49 @@
+# admin_panel.py
+# Панель администратора (Flask-Admin) на /admin, вход по ADMIN_USERNAME / ADMIN_PASSWORD.
+# Подключается, только если в APP_COMPONENTS есть admin (см. custom_provider.py),
+# поэтому воркеры, обслуживающие только API, не импортируют Flask-Admin.
+import os
+import secrets
+
+from flask import request, Response
+from flask_admin import Admin, AdminIndexView
+from flask_admin.contrib.sqla import ModelView
+
+from models import db, TARIFF_PLANS, User
+
+
+class ProtectedAdminIndexView(AdminIndexView):
+    def is_accessible(self):
+        auth = request.authorization; admin_user = os.environ.get('ADMIN_USERNAME'); admin_pass = os.environ.get('ADMIN_PASSWORD')
+        return auth and auth.username == admin_user and auth.password == admin_pass
+    def inaccessible_callback(self, name, **kwargs):
+        return Response('Login Required', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
+
+class UserAdminView(ModelView):
+    column_list = ('username', 'api_key', 'plan', 'message_count', 'message_limit', 'token_count', 'token_limit')
+    column_editable_list = ('message_limit', 'token_limit', 'username', 'plan')
+
+    def __init__(self, *args, auth_cache, **kwargs):
+        self.auth_cache = auth_cache
+        super().__init__(*args, **kwargs)
+
+    def on_model_change(self, form, model, is_created):
+        if is_created or form.plan.data != model.plan:
+             model.message_limit = TARIFF_PLANS.get(model.plan, {}).get('limit', 100)
+             model.token_limit = TARIFF_PLANS.get(model.plan, {}).get('token_limit', TARIFF_PLANS['free']['token_limit'])
+        if is_created:
+            model.api_key = f"user-{secrets.token_hex(16)}"
+        self.auth_cache.invalidate(model.api_key)
+    def after_model_change(self, form, model, is_created):
+        # Повторно сбрасываем уже после commit: параллельный запрос мог успеть
+        # положить в кэш старые данные между on_model_change и записью в БД
+        self.auth_cache.invalidate(model.api_key)
+    def after_model_delete(self, model):
+        self.auth_cache.invalidate(model.api_key)
+
+
+def init_app(app, auth_cache):
+    app.config.setdefault('FLASK_ADMIN_SWATCH', 'cerulean')
+    admin = Admin(app, name='Панель Управления', index_view=ProtectedAdminIndexView())
+    admin.add_view(UserAdminView(User, db.session, name='Пользователи', auth_cache=auth_cache))
+    return admin
@@ -0,0 +1,85 @@
+# auth_cache.py
+# Кэш аутентифицированных пользователей в памяти процесса (LRU + TTL).
+# Ключ кэша - SHA-256 от API-ключа, сами ключи в памяти словаря не храним.
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class CachedUser:
+    """Легкий снимок строки users. В отличие от модели SQLAlchemy не привязан к сессии,
+    поэтому его можно безопасно держать между запросами и потоками."""
+    __slots__ = ('api_key', 'username', 'plan', 'message_count', 'message_limit', 'token_count', 'token_limit')
+
+    def __init__(self, api_key, username, plan, message_count, message_limit, token_count=0, token_limit=0):
+        self.api_key = api_key
+        self.username = username
+        self.plan = plan
+        self.message_count = message_count
+        self.message_limit = message_limit
+        self.token_count = token_count
+        self.token_limit = token_limit
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(user.api_key, user.username, user.plan, user.message_count, user.message_limit,
+                   user.token_count, user.token_limit)
+
+
+def hash_key(api_key):
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class AuthCache:
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # hash(api_key) -> (expires_at, CachedUser)
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        key = hash_key(api_key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def peek(self, api_key):
+        """Как get, но без учета в статистике и без проверки TTL."""
+        with self._lock:
+            entry = self._data.get(hash_key(api_key))
+            return entry[1] if entry is not None else None
+
+    def put(self, api_key, user):
+        key = hash_key(api_key)
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, user)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return user
+
+    def invalidate(self, api_key):
+        if not api_key:
+            return
+        with self._lock:
+            self._data.pop(hash_key(api_key), None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data),
+                    "maxsize": self.maxsize, "ttl": self.ttl}
@@ -0,0 +1,220 @@
+# balancer.py
+# Балансировка между несколькими бэкендами одного алиаса модели
+# (несколько API-ключей и/или провайдеров), circuit breaker на каждый бэкенд
+# и повтор запроса с экспоненциальной задержкой со случайным разбросом (jitter) на 429/5xx.
+import os
+import json
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+from metrics import Counter, Histogram, CallbackGauge
+
+MAX_ATTEMPTS = int(os.environ.get('UPSTREAM_MAX_ATTEMPTS', 3))
+BACKOFF_BASE = float(os.environ.get('UPSTREAM_BACKOFF_BASE', 0.25))
+BACKOFF_MAX = float(os.environ.get('UPSTREAM_BACKOFF_MAX', 4))
+# Сколько ошибок подряд выключают бэкенд и на сколько секунд
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_COOLDOWN = float(os.environ.get('CIRCUIT_COOLDOWN', 30))
+# Коэффициент сглаживания для средней задержки (EWMA)
+LATENCY_ALPHA = 0.2
+
+# 401/403 тоже считаем отказом бэкенда: скорее всего, отозван конкретный ключ, а другие рабочие
+RETRYABLE_STATUSES = {401, 403, 408, 409, 429, 500, 502, 503, 504}
+
+
+UPSTREAM_DURATION = Histogram('llm_proxy_upstream_request_duration_seconds',
+                              'Duration of upstream provider calls (until response headers for streams)',
+                              ('model', 'backend', 'outcome'))
+UPSTREAM_ERRORS = Counter('llm_proxy_upstream_errors_total', 'Failed upstream provider calls by error class',
+                          ('model', 'backend', 'error'))
+
+
+def error_class(exc):
+    if isinstance(exc, requests.exceptions.Timeout):
+        return 'timeout'
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        return 'connection'
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        if response.status_code == 429:
+            return 'rate_limited'
+        if response.status_code in (401, 403):
+            return 'auth'
+        if response.status_code >= 500:
+            return 'server_error'
+        return 'client_error'
+    return type(exc).__name__
+
+def is_retryable(exc):
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRYABLE_STATUSES
+    return False
+
+def retry_after(exc):
+    """Значение Retry-After из ответа провайдера в секундах (или None)."""
+    response = getattr(exc, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+class Backend:
+    def __init__(self, config, index):
+        self.config = config
+        self.weight = float(config.get('weight', 1))
+        # Имя для логов и метрик - без API-ключа
+        self.name = f"{config['provider']}:{urlsplit(config['provider_url']).netloc}#{index}"
+        self.latency = None  # EWMA в секундах, None - еще не измеряли
+        self.in_flight = 0
+        self.failures = 0
+        self.open_until = 0.0
+        self.half_open = False
+
+    def available(self, now):
+        # closed - доступен; open - недоступен до open_until; потом half-open: пускаем один пробный запрос.
+        # Без побочных эффектов: half_open ставит _choose только выбранному бэкенду
+        if self.failures < CIRCUIT_FAILURE_THRESHOLD:
+            return True
+        return self.open_until <= now and not self.half_open
+
+    def record_success(self, duration):
+        self.failures = 0
+        self.half_open = False
+        self.latency = duration if self.latency is None else (1 - LATENCY_ALPHA) * self.latency + LATENCY_ALPHA * duration
+
+    def record_failure(self):
+        self.failures += 1
+        self.half_open = False
+        if self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+            self.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            print(f"ОШИБКА: Бэкенд {self.name} выключен на {CIRCUIT_COOLDOWN:.0f} с после {self.failures} ошибок подряд")
+
+
+class BackendPool:
+    def __init__(self, alias, backends, routing='weighted'):
+        self.alias = alias
+        self.routing = routing
+        self.backends = [Backend(config, index) for index, config in enumerate(backends)]
+        self._lock = threading.Lock()
+
+    def _choose(self, exclude):
+        now = time.monotonic()
+        candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+        if not candidates:
+            # Все выключены - лучше попробовать, чем сразу отказать: берем тот, что включится раньше всех
+            candidates = [min((b for b in self.backends if b not in exclude), key=lambda b: b.open_until, default=None)]
+            if candidates[0] is None:
+                return None
+        if self.routing == 'least_latency':
+            # Неизмеренные бэкенды считаем самыми быстрыми, чтобы каждый получил хотя бы один запрос
+            backend = min(candidates, key=lambda b: (b.latency or 0.0) * (b.in_flight + 1))
+        else:
+            backend = random.choices(candidates, weights=[b.weight for b in candidates])[0]
+        if backend.failures >= CIRCUIT_FAILURE_THRESHOLD and backend.open_until <= now:
+            # Выбран бэкенд после остывания - это и есть пробный запрос
+            backend.half_open = True
+        return backend
+
+    def call(self, fn):
+        """Вызывает fn(backend_config) на выбранном бэкенде, при отказе - на следующем.
+        Возвращает (backend, результат). После исчерпания попыток пробрасывает последнюю ошибку."""
+        tried = []
+        last_error = None
+        for attempt in range(MAX_ATTEMPTS):
+            with self._lock:
+                backend = self._choose(tried)
+                if backend is None:
+                    # Все бэкенды уже пробовали - повторяем по кругу, но с задержкой
+                    tried = []
+                    backend = self._choose(tried)
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+                    wait = retry_after(last_error)
+                    delay = wait if wait is not None and wait <= BACKOFF_MAX else random.uniform(0, delay)
+                else:
+                    delay = 0
+                backend.in_flight += 1
+            if delay:
+                time.sleep(delay)
+            started = time.monotonic()
+            try:
+                result = fn(backend.config)
+            except Exception as e:
+                UPSTREAM_DURATION.observe(time.monotonic() - started, model=self.alias, backend=backend.name, outcome='error')
+                UPSTREAM_ERRORS.inc(model=self.alias, backend=backend.name, error=error_class(e))
+                with self._lock:
+                    backend.in_flight -= 1
+                    if not is_retryable(e):
+                        # Бэкенд ответил (например, 400 на сам запрос) - это не его отказ, но пробный
+                        # запрос half-open завершен: иначе бэкенд навсегда останется недоступным
+                        backend.half_open = False
+                        raise
+                    backend.record_failure()
+                print(f"ОШИБКА: {self.alias}: бэкенд {backend.name} не ответил (попытка {attempt + 1}/{MAX_ATTEMPTS}): {e}")
+                last_error = e
+                tried.append(backend)
+                continue
+            duration = time.monotonic() - started
+            UPSTREAM_DURATION.observe(duration, model=self.alias, backend=backend.name, outcome='ok')
+            with self._lock:
+                backend.in_flight -= 1
+                backend.record_success(duration)
+            return backend, result
+        raise last_error
+
+    def report_failure(self, backend, error=None):
+        """Отказ, обнаруженный уже после успешного открытия (например, оборвался поток)."""
+        UPSTREAM_ERRORS.inc(model=self.alias, backend=backend.name,
+                            error=error_class(error) if error is not None else 'stream_interrupted')
+        with self._lock:
+            backend.record_failure()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return [{"backend": b.name, "weight": b.weight, "latency": b.latency, "in_flight": b.in_flight,
+                     "failures": b.failures, "open": b.failures >= CIRCUIT_FAILURE_THRESHOLD and b.open_until > now}
+                    for b in self.backends]
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(alias, model_config):
+    """Пул для алиаса. Пересоздается только если поменялся список бэкендов,
+    поэтому состояние circuit breaker'ов переживает повторные вызовы."""
+    signature = json.dumps([model_config.get('routing'), model_config['backends']], sort_keys=True)
+    with _pools_lock:
+        entry = _pools.get(alias)
+        if entry is None or entry[0] != signature:
+            entry = (signature, BackendPool(alias, model_config['backends'], model_config.get('routing', 'weighted')))
+            _pools[alias] = entry
+        return entry[1]
+
+def prune_pools(aliases):
+    """Удаляет пулы алиасов, которых больше нет в конфигурации моделей."""
+    with _pools_lock:
+        for alias in [alias for alias in _pools if alias not in aliases]:
+            del _pools[alias]
+
+def all_pools():
+    with _pools_lock:
+        return {alias: entry[1] for alias, entry in _pools.items()}
+
+def _circuit_states():
+    states = {}
+    for alias, pool in all_pools().items():
+        for backend in pool.stats():
+            states[(alias, backend["backend"])] = 1 if backend["open"] else 0
+    return states
+
+CallbackGauge('llm_proxy_upstream_circuit_open', 'Whether the circuit breaker of a backend is open (1) or closed (0)',
+              _circuit_states, ('model', 'backend'))
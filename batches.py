@@ -0,0 +1,261 @@
+# batches.py
+# Пакетное выполнение запросов к /v1/chat/completions: фоновые пакеты (/v1/batches, JSONL-файл)
+# и синхронный пакет в одном HTTP-запросе. Запросы выполняются в собственном пуле потоков,
+# а не в потоках gunicorn, с ограничением одновременных запросов к каждому провайдеру.
+# Хранение (таблицы batch_requests и др.) - в custom_provider.py, сюда передаются функции.
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+from balancer import is_retryable, retry_after, error_class
+from metrics import Counter
+
+# Сколько запросов фоновых пакетов выполняется одновременно (на воркер gunicorn)
+WORKERS = int(os.environ.get('BATCH_WORKERS', 16))
+# Отдельные потоки для синхронных пакетов, чтобы они не ждали в очереди за фоновыми
+SYNC_WORKERS = int(os.environ.get('BATCH_SYNC_WORKERS', 16))
+# Одновременных запросов к одному провайдеру из пакетов
+PROVIDER_CONCURRENCY = int(os.environ.get('BATCH_PROVIDER_CONCURRENCY', 8))
+MAX_ATTEMPTS = int(os.environ.get('BATCH_MAX_ATTEMPTS', 5))
+# Пауза перед повтором, если провайдер не прислал Retry-After
+RETRY_DELAY = float(os.environ.get('BATCH_RETRY_DELAY', 5))
+POLL_INTERVAL = float(os.environ.get('BATCH_POLL_INTERVAL', 2))
+# Запрос в статусе running дольше этого считается брошенным (воркер упал) и возвращается в очередь
+CLAIM_TTL = float(os.environ.get('BATCH_CLAIM_TTL', 900))
+MAX_REQUESTS = int(os.environ.get('BATCH_MAX_REQUESTS', 50000))
+SYNC_MAX_REQUESTS = int(os.environ.get('BATCH_SYNC_MAX_REQUESTS', 100))
+FILE_MAX_BYTES = int(os.environ.get('BATCH_FILE_MAX_BYTES', 50 * 1024 * 1024))
+
+BATCH_REQUESTS = Counter('llm_proxy_batch_requests_total', 'Batch requests by mode and outcome', ('mode', 'outcome'))
+
+
+def parse_input_file(content, endpoint):
+    """Разбирает JSONL-файл пакета. Возвращает [(custom_id, body)], при ошибке бросает
+    ValueError с номером строки."""
+    items = []
+    seen = set()
+    for number, line in enumerate(content.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {number}: invalid JSON")
+        if not isinstance(entry, dict):
+            raise ValueError(f"line {number}: expected a JSON object")
+        custom_id = entry.get('custom_id')
+        if not isinstance(custom_id, str) or not custom_id:
+            raise ValueError(f"line {number}: custom_id is required")
+        if custom_id in seen:
+            raise ValueError(f"line {number}: duplicate custom_id '{custom_id}'")
+        seen.add(custom_id)
+        if entry.get('method', 'POST').upper() != 'POST' or entry.get('url', endpoint) != endpoint:
+            raise ValueError(f"line {number}: only POST {endpoint} is supported")
+        error = validate_body(entry.get('body'))
+        if error:
+            raise ValueError(f"line {number}: {error}")
+        items.append((custom_id, entry['body']))
+        if len(items) > MAX_REQUESTS:
+            raise ValueError(f"too many requests, the limit is {MAX_REQUESTS}")
+    if not items:
+        raise ValueError("the input file has no requests")
+    return items
+
+
+def validate_body(body):
+    if not isinstance(body, dict):
+        return "body must be a JSON object"
+    if not body.get('model'):
+        return "body.model is required"
+    if not isinstance(body.get('messages'), list) or not body['messages']:
+        return "body.messages must be a non-empty list"
+    if body.get('stream'):
+        return "streaming is not supported in batches"
+    return None
+
+
+def error_response(exc):
+    """(код, тело) для ошибки провайдера, которую не удалось обойти повторами."""
+    response = getattr(exc, 'response', None)
+    status = response.status_code if response is not None and response.status_code == 429 else 502
+    return status, {"error": {"message": f"The underlying model provider failed: {exc}", "code": error_class(exc)}}
+
+
+class ProviderGates:
+    """Семафор на провайдера и общая пауза, если провайдер ответил 429."""
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self._semaphores = {}
+        self._paused_until = {}
+        self._lock = threading.Lock()
+
+    def _semaphore(self, key):
+        with self._lock:
+            semaphore = self._semaphores.get(key)
+            if semaphore is None:
+                semaphore = self._semaphores[key] = threading.BoundedSemaphore(self.concurrency)
+            return semaphore
+
+    @contextmanager
+    def hold(self, key):
+        semaphore = self._semaphore(key)
+        semaphore.acquire()
+        try:
+            wait = self._paused_until.get(key, 0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            yield
+        finally:
+            semaphore.release()
+
+    def pause(self, key, seconds):
+        with self._lock:
+            self._paused_until[key] = max(self._paused_until.get(key, 0), time.monotonic() + seconds)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {key: {"paused": max(0.0, round(self._paused_until.get(key, 0) - now, 1))}
+                    for key in self._semaphores}
+
+
+class BatchRunner:
+    def __init__(self, complete_fn, gate_fn, claim_fn, finish_fn, retry_fn, reclaim_fn=None,
+                 workers=WORKERS, sync_workers=SYNC_WORKERS, gates=None):
+        # complete_fn(api_key, body, **options) -> (код, тело ответа); ошибки провайдера пробрасывает как RequestException
+        # gate_fn(body) -> ключ провайдера для ProviderGates
+        # claim_fn(limit) -> [{"id", "api_key", "body", "attempts"}] - атомарно забирает запросы из очереди
+        # finish_fn(request_id, код, тело) - сохраняет результат
+        # retry_fn(request_id, delay) - возвращает запрос в очередь не раньше чем через delay секунд
+        # reclaim_fn() - возвращает в очередь брошенные запросы (раз в CLAIM_TTL / 4)
+        self.complete_fn = complete_fn
+        self.gate_fn = gate_fn
+        self.claim_fn = claim_fn
+        self.finish_fn = finish_fn
+        self.retry_fn = retry_fn
+        self.reclaim_fn = reclaim_fn
+        self.workers = workers
+        self.sync_workers = sync_workers
+        self.gates = gates or ProviderGates(PROVIDER_CONCURRENCY)
+        self._active = 0
+        self._cond = threading.Condition()
+        self._wake = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._stopped = False
+        self._reclaimed_at = 0
+
+    def ensure_started(self):
+        if self._thread is not None or self._stopped:
+            return
+        with self._cond:
+            if self._thread is None:
+                # Потоки создаются при первом запросе, т.е. уже внутри воркера gunicorn (после fork).
+                # Незаконченные пакеты после перезапуска продолжатся отсюда же.
+                self._executor = ThreadPoolExecutor(self.workers + self.sync_workers, thread_name_prefix='batch')
+                self._thread = threading.Thread(target=self._run, name='batch-runner', daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while not self._stopped:
+            with self._cond:
+                while self._active >= self.workers and not self._stopped:
+                    self._cond.wait()
+                free = self.workers - self._active
+            items = []
+            try:
+                if self.reclaim_fn and time.monotonic() - self._reclaimed_at > CLAIM_TTL / 4:
+                    self._reclaimed_at = time.monotonic()
+                    self.reclaim_fn()
+                items = self.claim_fn(free)
+            except Exception as e:
+                print(f"ОШИБКА: Не удалось выбрать запросы пакетов из БД: {e}")
+            if not items:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            with self._cond:
+                self._active += len(items)
+            for item in items:
+                self._executor.submit(self._process, item)
+
+    def _process(self, item):
+        try:
+            key = self.gate_fn(item['body'])
+            try:
+                with self.gates.hold(key):
+                    status, body = self.complete_fn(item['api_key'], item['body'])
+            except requests.exceptions.RequestException as e:
+                delay = self._backoff(key, e)
+                if is_retryable(e) and item['attempts'] < MAX_ATTEMPTS:
+                    BATCH_REQUESTS.inc(mode='async', outcome='retry')
+                    self.retry_fn(item['id'], delay)
+                    return
+                status, body = error_response(e)
+            except Exception as e:
+                print(f"ОШИБКА: Запрос пакета {item['id']} завершился ошибкой: {e}")
+                status, body = 500, {"error": {"message": "Internal error while processing the request.", "code": "internal"}}
+            BATCH_REQUESTS.inc(mode='async', outcome='ok' if status < 400 else 'error')
+            self.finish_fn(item['id'], status, body)
+        except Exception as e:
+            # Запрос останется в running и вернется в очередь через CLAIM_TTL
+            print(f"ОШИБКА: Не удалось сохранить результат запроса пакета {item['id']}: {e}")
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify()
+
+    def _backoff(self, key, error):
+        # 429 от провайдера притормаживает все пакетные запросы к нему, а не только этот
+        wait = retry_after(error)
+        response = getattr(error, 'response', None)
+        if response is not None and response.status_code == 429:
+            self.gates.pause(key, wait if wait is not None else RETRY_DELAY)
+        return wait if wait is not None else RETRY_DELAY
+
+    def run_many(self, api_key, bodies, **options):
+        """Синхронный пакет: выполняет запросы параллельно и возвращает [(код, тело)] в том же порядке.
+        options передаются в complete_fn."""
+        self.ensure_started()
+        futures = [self._executor.submit(self._complete_sync, api_key, body, options) for body in bodies]
+        return [future.result() for future in futures]
+
+    def _complete_sync(self, api_key, body, options):
+        key = self.gate_fn(body)
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                with self.gates.hold(key):
+                    status, result = self.complete_fn(api_key, body, **options)
+            except requests.exceptions.RequestException as e:
+                delay = self._backoff(key, e)
+                # Остальные ошибки BackendPool уже повторил с задержками - повторяем только 429,
+                # и только если пауза короткая (клиент ждет ответа). Саму паузу выдержит gates.hold()
+                response = getattr(e, 'response', None)
+                if (response is not None and response.status_code == 429
+                        and attempt < MAX_ATTEMPTS and delay <= RETRY_DELAY):
+                    BATCH_REQUESTS.inc(mode='sync', outcome='retry')
+                    continue
+                BATCH_REQUESTS.inc(mode='sync', outcome='error')
+                return error_response(e)
+            BATCH_REQUESTS.inc(mode='sync', outcome='ok' if status < 400 else 'error')
+            return status, result
+
+    def stats(self):
+        with self._cond:
+            active = self._active
+        return {"active": active, "workers": self.workers, "providers": self.gates.stats()}
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        with self._cond:
+            self._cond.notify_all()
@@ -0,0 +1,189 @@
+# benchmark.py
+# Нагрузочный тест прокси: поднимает локальную заглушку провайдера (mock_provider.py),
+# направляет на нее все модели из model_mapping и гоняет /v1/chat/completions
+# с заданной параллельностью. Работает на временной копии базы, боевой users.db не трогает.
+#
+# Пример: python benchmark.py --requests 2000 --concurrency 64 --latency 0.5 --stream-ratio 0.5
+import os
+import sys
+import json
+import time
+import logging
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from werkzeug.serving import make_server
+
+from mock_provider import MockConfig, start_in_thread
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def load_app(db_path):
+    """Импортирует custom_provider с временной базой и фиктивными ключами провайдеров."""
+    os.environ['DATABASE_PATH'] = db_path
+    for name in ('OPENAI_API_KEY', 'GOOGLE_API_KEY', 'GROQ_API_KEY'):
+        os.environ[name] = os.environ.get('BENCH_' + name, 'bench-key')
+    # Меряем накладные расходы прокси, а не лимиты тарифа; RATE_LIMIT=memory|sqlite включит их явно
+    os.environ.setdefault('RATE_LIMIT', 'off')
+    # Временная база создается через create_all, проверять версию схемы не нужно
+    os.environ.setdefault('SCHEMA_CHECK', 'off')
+    import custom_provider
+    return custom_provider
+
+
+def point_models_at(cp, base_url):
+    for config in cp.model_mapping.current().values():
+        for backend in config['backends']:
+            if backend['provider'] == 'google':
+                backend['provider_url'] = f"{base_url}/v1beta/models/{backend['real_model']}:generateContent?key={backend['api_key']}"
+            else:
+                backend['provider_url'] = f"{base_url}/v1/chat/completions"
+
+
+def create_users(cp, count):
+    keys = []
+    with cp.app.app_context():
+        cp.db.create_all()
+        for index in range(count):
+            api_key = f"user-bench-{uuid.uuid4().hex}"
+            cp.db.session.add(cp.User(api_key=api_key, username=f"bench-{index}-{api_key[-6:]}",
+                                      message_limit=10 ** 9, token_limit=10 ** 12, plan='enterprise'))
+            keys.append(api_key)
+        cp.db.session.commit()
+    return keys
+
+
+def run_one(session, url, api_key, model, stream, prompt, service_time):
+    # service_time - сколько по настройкам "думает" заглушка; остаток задержки - накладные расходы прокси
+    body = {"model": model, "stream": stream, "messages": [{"role": "user", "content": prompt}]}
+    started = time.perf_counter()
+    ttfb = None
+    stream_error = False
+    response = session.post(url, json=body, headers={'Authorization': f'Bearer {api_key}'}, stream=stream)
+    if stream:
+        for line in response.iter_lines():
+            if line.startswith(b'data: {"error"'):
+                stream_error = True
+            elif ttfb is None and b'"content"' in line and b'"content": ""' not in line:
+                ttfb = time.perf_counter() - started
+    else:
+        response.content
+    total = time.perf_counter() - started
+    ok = response.status_code == 200 and not stream_error
+    return {"ok": ok, "status": response.status_code if not stream_error else 'stream_error', "latency": total,
+            "ttfb": ttfb if stream else total, "overhead": max(0.0, total - service_time) if ok else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест прокси на локальной заглушке провайдера.")
+    parser.add_argument('--requests', type=int, default=500, help='Сколько запросов отправить (по умолчанию: 500)')
+    parser.add_argument('--concurrency', type=int, default=32, help='Одновременных клиентов (по умолчанию: 32)')
+    parser.add_argument('--stream-ratio', type=float, default=0.0, help='Доля потоковых запросов (по умолчанию: 0)')
+    parser.add_argument('--model', action='append', help='Алиас модели (можно несколько раз; по умолчанию все)')
+    parser.add_argument('--users', type=int, default=10, help='Сколько тестовых пользователей создать (по умолчанию: 10)')
+    parser.add_argument('--same-prompt', action='store_true', help='Один и тот же промпт во всех запросах (проверка кэша и single-flight)')
+    parser.add_argument('--latency', type=float, default=0.2, help='Задержка заглушки до первого токена, с')
+    parser.add_argument('--tokens', type=int, default=50, help='Токенов в ответе заглушки')
+    parser.add_argument('--token-rate', type=float, default=500, help='Скорость генерации заглушки, токенов/с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ошибок заглушки')
+    parser.add_argument('--json', action='store_true', help='Вывести результат в JSON')
+    args = parser.parse_args()
+    # Журнал werkzeug пишет по строке на запрос от обоих серверов (прокси и заглушки) и прячет отчет
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    mock_config = MockConfig(args.latency, args.tokens, args.token_rate, args.error_rate)
+    mock_server, mock_url = start_in_thread(mock_config)
+    service_time = mock_config.latency + mock_config.generation_time()
+
+    db_dir = tempfile.mkdtemp(prefix='llm-bench-')
+    cp = load_app(os.path.join(db_dir, 'bench.db'))
+    point_models_at(cp, mock_url)
+    keys = create_users(cp, args.users)
+    models = args.model or list(cp.model_mapping.current())
+    if not models:
+        sys.exit("❌ Нет ни одной модели (MODEL_CONFIG или ключи провайдеров)")
+
+    app_server = make_server('127.0.0.1', 0, cp.app, threaded=True)
+    threading.Thread(target=app_server.serve_forever, name='bench-app', daemon=True).start()
+    url = f"http://127.0.0.1:{app_server.server_port}/v1/chat/completions"
+
+    local = threading.local()
+    def task(index):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        prompt = "benchmark prompt" if args.same_prompt else f"benchmark prompt #{index} {uuid.uuid4().hex}"
+        try:
+            return run_one(session, url, random.choice(keys), random.choice(models),
+                           random.random() < args.stream_ratio, prompt, service_time)
+        except requests.exceptions.RequestException as e:
+            return {"ok": False, "status": type(e).__name__, "latency": 0.0, "ttfb": None, "overhead": None}
+
+    rows_before = {kind: cp.DB_WRITE_ROWS.value(kind=kind) for kind in ('usage', 'message_log')}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(task, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    # Дописываем отложенные счетчики и лог, чтобы учесть их в скорости записи в БД
+    cp.usage.flush()
+    if cp.message_log is not None:
+        cp.message_log.flush()
+
+    ok = [r for r in results if r["ok"]]
+    latencies = [r["latency"] for r in ok]
+    overheads = [r["overhead"] for r in ok if r["overhead"] is not None]
+    ttfbs = [r["ttfb"] for r in ok if r["ttfb"] is not None]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[str(r["status"])] = errors.get(str(r["status"]), 0) + 1
+    db_writes = {}
+    for kind in ('usage', 'message_log'):
+        count, total = cp.DB_WRITE_DURATION.summary(kind=kind)
+        db_writes[kind] = {"rows": cp.DB_WRITE_ROWS.value(kind=kind) - rows_before[kind], "batches": count,
+                           "rows_per_second": (cp.DB_WRITE_ROWS.value(kind=kind) - rows_before[kind]) / elapsed,
+                           "avg_batch_ms": total / count * 1000 if count else 0.0}
+
+    report = {
+        "requests": args.requests, "concurrency": args.concurrency, "stream_ratio": args.stream_ratio,
+        "elapsed_s": elapsed, "throughput_rps": len(ok) / elapsed, "ok": len(ok), "errors": errors,
+        "latency_ms": {p: percentile(latencies, p) * 1000 for p in (50, 90, 99)},
+        "ttfb_ms": {p: percentile(ttfbs, p) * 1000 for p in (50, 99)},
+        "proxy_overhead_ms": {p: percentile(overheads, p) * 1000 for p in (50, 99)},
+        "db_writes": db_writes,
+        "upstream_calls": mock_server.app.config['MOCK_STATS']["requests"],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("=" * 70)
+        print(f"Запросов: {args.requests}, параллельно: {args.concurrency}, потоковых: {args.stream_ratio:.0%}")
+        print(f"Время: {elapsed:.2f} с, пропускная способность: {report['throughput_rps']:.1f} запр/с")
+        print(f"Успешно: {len(ok)}, ошибки: {errors or 'нет'}, вызовов заглушки: {report['upstream_calls']}")
+        print(f"Задержка p50/p90/p99: {report['latency_ms'][50]:.1f} / {report['latency_ms'][90]:.1f} / {report['latency_ms'][99]:.1f} мс")
+        print(f"Первый токен p50/p99: {report['ttfb_ms'][50]:.1f} / {report['ttfb_ms'][99]:.1f} мс")
+        print(f"Накладные расходы прокси p50/p99: {report['proxy_overhead_ms'][50]:.1f} / {report['proxy_overhead_ms'][99]:.1f} мс")
+        for kind, stats in db_writes.items():
+            print(f"Запись в БД ({kind}): {stats['rows']} строк, {stats['batches']} пачек, "
+                  f"{stats['rows_per_second']:.1f} строк/с, {stats['avg_batch_ms']:.2f} мс на пачку")
+        print("=" * 70)
+
+    app_server.shutdown()
+    mock_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# billing.py
+# Оплата тарифов через Stripe: переход к оплате и вебхук checkout.session.completed.
+# Подключается, если в APP_COMPONENTS есть billing (см. custom_provider.py).
+# Модуль stripe импортируется при первом обращении к оплате, а не при старте воркера.
+import os
+
+from flask import Blueprint, request, redirect, session, abort
+
+from models import db, TARIFF_PLANS, User
+
+bp = Blueprint('billing', __name__)
+
+YOUR_DOMAIN = os.environ.get('YOUR_DOMAIN', 'http://127.0.0.1:8088')
+
+_stripe = None
+_auth_cache = None
+
+
+def _client():
+    global _stripe
+    if _stripe is None:
+        # Повторный импорт из параллельного потока безопасен, модуль загрузится один раз
+        import stripe
+        stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+        _stripe = stripe
+    return _stripe
+
+
+@bp.route('/create-checkout-session/<plan>')
+def create_checkout_session(plan):
+    if 'api_key' not in session:
+        # Страница входа - в личном кабинете (web_ui.py), он может работать и в другом процессе
+        return redirect('/login')
+    if plan not in TARIFF_PLANS:
+        return abort(404)
+
+    try:
+        checkout_session = _client().checkout.Session.create(
+            line_items=[{'price': TARIFF_PLANS[plan]['stripe_price_id'], 'quantity': 1}],
+            mode='payment',
+            success_url=YOUR_DOMAIN + '/profile?payment=success',
+            cancel_url=YOUR_DOMAIN + '/profile?payment=cancel',
+            # ВАЖНО: передаем ключ пользователя, чтобы знать, кого обновлять
+            client_reference_id=session['api_key']
+        )
+    except Exception as e:
+        return str(e)
+
+    return redirect(checkout_session.url, code=303)
+
+@bp.route('/stripe-webhook', methods=['POST'])
+def stripe_webhook():
+    stripe = _client()
+    payload = request.data
+    sig_header = request.headers.get('Stripe-Signature')
+    event = None
+
+    try:
+        event = stripe.Webhook.construct_event(payload, sig_header, os.environ.get('STRIPE_WEBHOOK_SECRET'))
+    except ValueError as e: # Неверный payload
+        return 'Invalid payload', 400
+    except stripe.error.SignatureVerificationError as e: # Неверная подпись
+        return 'Invalid signature', 400
+
+    # Обрабатываем событие checkout.session.completed
+    if event['type'] == 'checkout.session.completed':
+        session_data = event['data']['object']
+        api_key = session_data.get('client_reference_id')
+        # Тут может быть логика поиска плана по price_id, но для простоты мы найдем по api_key
+        user = User.query.get(api_key)
+        if user:
+            # Находим, какой план был куплен (в реальном проекте - по ID)
+            # Здесь для простоты обновим до 'pro'
+            new_plan = 'pro' # <-- В проде нужно определять по session_data
+            user.plan = new_plan
+            user.message_limit = TARIFF_PLANS[new_plan]['limit']
+            user.token_limit = TARIFF_PLANS[new_plan]['token_limit']
+            # Можно сбросить счетчик или добавить лимит к существующему
+            user.message_count = 0
+            user.token_count = 0
+            db.session.commit()
+            _auth_cache.invalidate(user.api_key)
+            print(f"✅ Пользователь {user.username} успешно обновил тариф до {new_plan}")
+
+    return 'OK', 200
+
+
+def init_app(app, auth_cache):
+    global _auth_cache
+    _auth_cache = auth_cache
+    app.register_blueprint(bp)
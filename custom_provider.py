@@ -1,220 +1,1040 @@
 # custom_provider.py
 import os
-import secrets
 import json
 import requests
 from functools import wraps
 from dotenv import load_dotenv
 import time
 import uuid
+import math
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
 
 
 
-from flask import Flask, jsonify, request, g, Response, render_template, redirect, url_for, session, abort
-from flask_sqlalchemy import SQLAlchemy
-from flask_admin import Admin, AdminIndexView
-from flask_admin.contrib.sqla import ModelView
-import stripe # <-- импортируем Stripe
+from flask import Flask, jsonify, request, g, Response, url_for, stream_with_context, after_this_request
+from sqlalchemy import text, event
+from sqlalchemy.engine import Engine
+import sqlite3
+
+from models import db, TARIFF_PLANS, User, Message, BatchFile, Batch, BatchRequest
+from upstream import call_provider, open_provider_stream, iter_provider_stream
+from auth_cache import AuthCache, CachedUser
+from usage import UsageAccumulator
+from response_cache import make_cache, is_cacheable, cache_key, sampling_params
+from semantic_cache import make_semantic_cache
+from message_log import MessageLogWriter
+from balancer import get_pool, prune_pools, retry_after
+from singleflight import SingleFlight
+import metrics
+from metrics import Counter, Histogram, CallbackGauge
+import tokens
+import migrations
+from model_config import ModelMapping
+from ratelimit import make_rate_limiter, RateLimits, RateLimited
+import batches
+from batches import BatchRunner
 
 load_dotenv()
 
 # --- ДИАГНОСТИЧЕСКИЙ БЛОК ---
-print("="*60)
-print("🕵️  ЗАПУСК ДИАГНОСТИКИ ЗАГРУЗКИ API-КЛЮЧЕЙ...")
-print(f"   OPENAI_API_KEY: {'✅ Загружен' if os.environ.get('OPENAI_API_KEY') else '❌ НЕ НАЙДЕН'}")
-print(f"   GOOGLE_API_KEY: {'✅ Загружен' if os.environ.get('GOOGLE_API_KEY') else '❌ НЕ НАЙДЕН'}")
-print(f"   GROQ_API_KEY:   {'✅ Загружен' if os.environ.get('GROQ_API_KEY') else '❌ НЕ НАЙДЕН'}")
-print("="*60)
-# --- КОНЕЦ ДИАГНОСТИЧЕСКОГО БЛОКА ---
-
-# --- ТАРИФНЫЕ ПЛАНЫ ---
-# Управляем всеми тарифами из одного места
-TARIFF_PLANS = {
-    'free': {'limit': 100, 'price': 0, 'stripe_price_id': 'YOUR_FREE_PLAN_ID'},
-    'pro': {'limit': 1000, 'price': 10, 'stripe_price_id': 'price_1SSI67RPenat6xXbIaMWAGdc'},
-    'enterprise': {'limit': 5000, 'price': 40, 'stripe_price_id': 'price_1SSI6fRPenat6xXbv14IqeUD'}
-}
+# Печатается при запуске через python custom_provider.py или при STARTUP_DIAGNOSTICS=1,
+# а не в каждом воркере gunicorn
+STARTUP_DIAGNOSTICS = os.environ.get('STARTUP_DIAGNOSTICS', '0') == '1'
 
+def print_diagnostics():
+    print("="*60)
+    print("🕵️  ЗАПУСК ДИАГНОСТИКИ ЗАГРУЗКИ API-КЛЮЧЕЙ...")
+    print(f"   OPENAI_API_KEY: {'✅ Загружен' if os.environ.get('OPENAI_API_KEY') else '❌ НЕ НАЙДЕН'}")
+    print(f"   GOOGLE_API_KEY: {'✅ Загружен' if os.environ.get('GOOGLE_API_KEY') else '❌ НЕ НАЙДЕН'}")
+    print(f"   GROQ_API_KEY:   {'✅ Загружен' if os.environ.get('GROQ_API_KEY') else '❌ НЕ НАЙДЕН'}")
+    print(f"   Компоненты:     {', '.join(['api'] + sorted(APP_COMPONENTS))}")
+    print(f"   Модели:         {', '.join(model_mapping.current()) or '❌ НЕТ НИ ОДНОЙ'}")
+    print("="*60)
+# --- КОНЕЦ ДИАГНОСТИЧЕСКОГО БЛОКА ---
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 DB_NAME = 'users.db'
+DB_PATH = os.environ.get('DATABASE_PATH', os.path.join(basedir, DB_NAME))
+
+# --- НАСТРОЙКИ SQLITE ---
+# WAL позволяет читать базу параллельно с записью, поэтому несколько воркеров gunicorn
+# могут работать с одним файлом. busy_timeout - сколько ждать блокировку вместо ошибки "database is locked".
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # в режиме WAL NORMAL безопасен и без fsync на каждый commit
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+@event.listens_for(Engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('MY_PROVIDER_API_KEY', 'default-secret-key-CHANGE-ME')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, DB_NAME)
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + DB_PATH
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['FLASK_ADMIN_SWATCH'] = 'cerulean'
+# Пул соединений на воркер: каждый поток берет свое соединение, а не открывает файл заново.
+# По умолчанию по соединению на каждый поток gunicorn (GUNICORN_THREADS) и сверху - на потоки
+# пакетов и фоновые записи, чтобы запрос не ждал свободного соединения до pool_timeout
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('SQLITE_POOL_SIZE', os.environ.get('GUNICORN_THREADS', 64))),
+    'max_overflow': int(os.environ.get('SQLITE_POOL_MAX_OVERFLOW', batches.WORKERS + batches.SYNC_WORKERS + 4)),
+    'pool_timeout': 30,
+    'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000, 'check_same_thread': False},
+}
 
-# --- Stripe Конфигурация ---
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-stripe_webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
 YOUR_DOMAIN = os.environ.get('YOUR_DOMAIN', 'http://127.0.0.1:8088')
 
+# Модели и тарифы (TARIFF_PLANS) описаны в models.py - общие с manage_users.py
+db.init_app(app)
+
+# --- ПРОВЕРКА ВЕРСИИ СХЕМЫ ---
+# SCHEMA_CHECK: warn (по умолчанию) - предупредить, что база не обновлена; strict - не запускаться;
+# migrate - применить недостающие миграции при старте (воркеры gunicorn делают это по очереди); off
+SCHEMA_CHECK = os.environ.get('SCHEMA_CHECK', 'warn').lower()
+if SCHEMA_CHECK == 'migrate':
+    migrations.migrate(DB_PATH)
+elif SCHEMA_CHECK != 'off':
+    schema_version, latest_schema_version = migrations.verify(DB_PATH)
+    if schema_version < latest_schema_version:
+        message = (f"Схема базы {DB_PATH} версии {schema_version}, а нужна {latest_schema_version}. "
+                   f"Выполните: python migrate.py")
+        if SCHEMA_CHECK == 'strict':
+            raise SystemExit(f"ОШИБКА: {message}")
+        print(f"ВНИМАНИЕ: {message}")
+
+# Кэш пользователей для require_api_key, чтобы не ходить в SQLite на каждый запрос
+auth_cache = AuthCache(maxsize=int(os.environ.get('AUTH_CACHE_SIZE', 10000)),
+                       ttl=float(os.environ.get('AUTH_CACHE_TTL', 60)))
+
+# --- МЕТРИКИ (отдаются на /metrics) ---
+HTTP_REQUESTS = Counter('llm_proxy_http_requests_total', 'HTTP requests by endpoint and status', ('endpoint', 'method', 'status'))
+HTTP_DURATION = Histogram('llm_proxy_http_request_duration_seconds', 'Time until response headers are sent', ('endpoint',))
+AUTH_DURATION = Histogram('llm_proxy_auth_duration_seconds', 'API key check duration', ('result',))
+UPSTREAM_TTFB = Histogram('llm_proxy_time_to_first_byte_seconds',
+                          'Time from request start to the first model token (whole answer for non-streaming)', ('model', 'stream'))
+TOKENS = Counter('llm_proxy_tokens_total', 'Tokens charged to users', ('model', 'kind', 'source'))
+RATE_LIMITED = Counter('llm_proxy_rate_limited_total', 'Requests rejected by per-key rate limits', ('plan', 'reason'))
+QUOTA_REJECTIONS = Counter('llm_proxy_quota_rejections_total', 'Requests rejected by quota', ('reason',))
+COMPLETION_ERRORS = Counter('llm_proxy_completion_errors_total', 'Failed chat completions by error class', ('model', 'error'))
+DB_WRITE_DURATION = Histogram('llm_proxy_db_write_duration_seconds', 'Batched DB write duration', ('kind',))
+DB_WRITE_ROWS = Counter('llm_proxy_db_write_rows_total', 'Rows written by batched DB writers', ('kind',))
+CACHE_EVENTS = Counter('llm_proxy_completion_cache_total', 'Completion cache lookups', ('result',))
+SEMANTIC_EVENTS = Counter('llm_proxy_semantic_cache_total', 'Semantic cache lookups by model alias', ('model', 'result'))
+SEMANTIC_SIMILARITY = Histogram('llm_proxy_semantic_cache_similarity', 'Best cosine similarity found by semantic cache lookups',
+                                ('model',), buckets=(0.5, 0.7, 0.8, 0.85, 0.9, 0.92, 0.95, 0.98, 0.99, 1.0))
+CallbackGauge('llm_proxy_auth_cache_events', 'Auth cache hits and misses since start',
+              lambda: {('hit',): auth_cache.hits, ('miss',): auth_cache.misses}, ('result',))
+CallbackGauge('llm_proxy_auth_cache_size', 'Users currently held in the auth cache', lambda: auth_cache.stats()["size"])
+
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    _resume_batches_once()
+
+@app.after_request
+def _record_request(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if 'request_started' in g:
+        HTTP_DURATION.observe(time.perf_counter() - g.request_started, endpoint=endpoint)
+    return response
+
+# --- КОМПОНЕНТЫ ---
+# API (/v1/...) есть всегда. Остальное подключается через APP_COMPONENTS (через запятую):
+# web - личный кабинет (web_ui.py), billing - оплата Stripe (billing.py), admin - /admin (admin_panel.py).
+# Модули отключенных компонентов не импортируются, поэтому воркеры только с API стартуют быстрее
+# и занимают меньше памяти; кабинет и админку можно запустить отдельным процессом с тем же DATABASE_PATH.
+OPTIONAL_COMPONENTS = ('web', 'billing', 'admin')
+APP_COMPONENTS = set()
+for component in (part.strip().lower() for part in os.environ.get('APP_COMPONENTS', ','.join(OPTIONAL_COMPONENTS)).split(',')):
+    if component in OPTIONAL_COMPONENTS:
+        APP_COMPONENTS.add(component)
+    elif component not in ('', 'api'):
+        print(f"ОШИБКА: Неизвестный компонент '{component}' в APP_COMPONENTS, пропущен")
+
+if 'web' in APP_COMPONENTS:
+    import web_ui
+    web_ui.init_app(app)
+if 'billing' in APP_COMPONENTS:
+    import billing
+    billing.init_app(app, auth_cache)
+if 'admin' in APP_COMPONENTS:
+    import admin_panel
+    admin_panel.init_app(app, auth_cache)
+
+
+# Каждый алиас - это пул бэкендов: у одного алиаса может быть несколько ключей и/или провайдеров,
+# и запросы будут распределяться между ними (см. model_config.py).
+# routing по умолчанию: 'weighted' (случайно по весам) или 'least_latency' (самый быстрый по последним ответам).
+MODEL_ROUTING = os.environ.get('MODEL_ROUTING', 'weighted')
+# MODEL_CONFIG - JSON-файл с алиасами (пример: model_config.example.json). Изменения в нем
+# подхватываются на лету; без файла алиасы строятся по OPENAI_API_KEY / GOOGLE_API_KEY / GROQ_API_KEY.
+model_mapping = ModelMapping(os.environ.get('MODEL_CONFIG') or None, default_routing=MODEL_ROUTING,
+                             check_interval=float(os.environ.get('MODEL_CONFIG_CHECK_INTERVAL', 2)),
+                             on_change=prune_pools)
 
-db = SQLAlchemy(app)
-
-# --- МОДЕЛИ (обновлена модель User) ---
-class User(db.Model):
-    __tablename__ = 'users'
-    api_key = db.Column(db.Text, primary_key=True)
-    username = db.Column(db.Text, unique=True, nullable=False)
-    message_count = db.Column(db.Integer, nullable=False, default=0)
-    message_limit = db.Column(db.Integer, nullable=False)
-    plan = db.Column(db.Text, nullable=False, default='free') # <-- НОВОЕ ПОЛЕ
-
-class Message(db.Model):
-    __tablename__ = 'messages'
-    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    user_api_key = db.Column(db.Text, db.ForeignKey('users.api_key'), nullable=False)
-    role = db.Column(db.Text, nullable=False)
-    content = db.Column(db.Text, nullable=False)
-    timestamp = db.Column(db.DateTime, server_default=db.func.now())
-
-class ProtectedAdminIndexView(AdminIndexView):
-    def is_accessible(self):
-        auth = request.authorization; admin_user = os.environ.get('ADMIN_USERNAME'); admin_pass = os.environ.get('ADMIN_PASSWORD')
-        return auth and auth.username == admin_user and auth.password == admin_pass
-    def inaccessible_callback(self, name, **kwargs):
-        return Response('Login Required', 401, {'WWW-Authenticate': 'Basic realm="Login Required"'})
-
-class UserAdminView(ModelView):
-    column_list = ('username', 'api_key', 'plan', 'message_count', 'message_limit')
-    column_editable_list = ('message_limit', 'username', 'plan')
-    def on_model_change(self, form, model, is_created):
-        if is_created or form.plan.data != model.plan:
-             model.message_limit = TARIFF_PLANS.get(model.plan, {}).get('limit', 100)
-        if is_created:
-            model.api_key = f"user-{secrets.token_hex(16)}"
-
-admin = Admin(app, name='Панель Управления', index_view=ProtectedAdminIndexView())
-admin.add_view(UserAdminView(User, db.session, name='Пользователи'))
-
-
-OPENAI_API_KEY = os.environ.get('OPENAI_API_KEY')
-GOOGLE_API_KEY = os.environ.get('GOOGLE_API_KEY')
-GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
-MODEL_MAPPING = {}
-if OPENAI_API_KEY: MODEL_MAPPING.update({"klassicheskiy-gpt4": {"provider": "openai", "real_model": "gpt-3.5-turbo", "provider_url": "https://api.openai.com/v1/chat/completions", "api_key": OPENAI_API_KEY}})
-if GOOGLE_API_KEY: MODEL_MAPPING.update({"tvoy-bystriy-gemini": {"provider": "google", "real_model": "gemini-2.0-flash", "provider_url": f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={GOOGLE_API_KEY}", "api_key": GOOGLE_API_KEY}})
-if GROQ_API_KEY: MODEL_MAPPING.update({"besplatniy-compound": { "provider": "openai", "real_model": "groq/compound-mini", "provider_url": "https://api.groq.com/openai/v1/chat/completions", "api_key": GROQ_API_KEY}})
 def require_api_key(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         auth_header = request.headers.get('Authorization');
         if not auth_header or not auth_header.startswith('Bearer '): return jsonify({"error": "Auth header is missing or invalid"}), 401
-        provided_key = auth_header.split(' ')[1]; user = User.query.filter_by(api_key=provided_key).first()
-        if not user: return jsonify({"error": "Invalid API key"}), 403
+        provided_key = auth_header.split(' ')[1]
+        started = time.perf_counter()
+        user = auth_cache.get(provided_key)
+        if user is None:
+            db_user = User.query.filter_by(api_key=provided_key).first()
+            user = CachedUser.from_model(db_user) if db_user else None
+            # Соединение сразу возвращаем в пул: иначе оно занято до конца запроса,
+            # т.е. на все время ответа провайдера (и всего стрима)
+            db.session.rollback()
+            if not user:
+                AUTH_DURATION.observe(time.perf_counter() - started, result='invalid')
+                return jsonify({"error": "Invalid API key"}), 403
+            user = auth_cache.put(provided_key, user)
+            AUTH_DURATION.observe(time.perf_counter() - started, result='db')
+        else:
+            AUTH_DURATION.observe(time.perf_counter() - started, result='cache')
         g.user = user; return f(*args, **kwargs)
     return decorated_function
 @app.route('/v1/models', methods=['GET'])
 @require_api_key
 def list_models():
-    return jsonify({"object": "list", "data": [{"id": model_id, "object": "model", "owned_by": "bratiwka-inc"} for model_id, details in MODEL_MAPPING.items() if details.get("api_key")]})
+    return jsonify({"object": "list", "data": [{"id": model_id, "object": "model", "owned_by": "bratiwka-inc"} for model_id, details in model_mapping.current().items() if details.get("backends")]})
+# --- ФОРМИРОВАНИЕ ОТВЕТОВ В ФОРМАТЕ OPENAI ---
+EMPTY_USAGE = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+def _usage_dict(prompt_tokens, completion_tokens):
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+def _completion_response(completion_id, model_id, content, usage=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_id,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": usage or dict(EMPTY_USAGE)
+    }
+
+def _completion_chunk(completion_id, model_id, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model_id,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+    }
+
+def _sse(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(generator):
+    # X-Accel-Buffering: no - чтобы nginx перед нами не копил поток целиком
+    return Response(stream_with_context(generator), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _stream_static_text(completion_id, model_id, content):
+    """Отдает готовый текст одним SSE-потоком (для клиентов, которые просили stream=true)."""
+    yield _sse(_completion_chunk(completion_id, model_id, {"role": "assistant", "content": content}))
+    yield _sse(_completion_chunk(completion_id, model_id, {}, finish_reason="stop"))
+    yield "data: [DONE]\n\n"
+
+
+# --- УЧЕТ СООБЩЕНИЙ ---
+def _flush_usage(increments):
+    # Одна транзакция на всю пачку: UPDATE ... SET message_count = message_count + ? через executemany
+    with app.app_context(), DB_WRITE_DURATION.time(kind='usage'):
+        db.session.execute(
+            text("UPDATE users SET message_count = message_count + :messages, token_count = token_count + :tokens "
+                 "WHERE api_key = :api_key"),
+            [{"api_key": api_key, "messages": messages, "tokens": tokens}
+             for api_key, (messages, tokens) in increments.items()]
+        )
+        db.session.commit()
+    DB_WRITE_ROWS.inc(len(increments), kind='usage')
+
+def _on_usage_flushed(api_key, messages, tokens):
+    # Приращение уже в БД - переносим его в снимок пользователя в auth_cache
+    user = auth_cache.peek(api_key)
+    if user is not None:
+        user.message_count += messages
+        user.token_count += tokens
+
+usage = UsageAccumulator(_flush_usage,
+                         interval=float(os.environ.get('USAGE_FLUSH_INTERVAL', 2)),
+                         max_pending=int(os.environ.get('USAGE_FLUSH_MAX_PENDING', 500)),
+                         on_flushed=_on_usage_flushed)
+
+
+# --- ЛОГ СООБЩЕНИЙ (пишется в фоне пачками, отключается MESSAGE_LOG=0) ---
+def _insert_messages(rows):
+    with app.app_context(), DB_WRITE_DURATION.time(kind='message_log'):
+        db.session.execute(Message.__table__.insert(), rows)
+        db.session.commit()
+    DB_WRITE_ROWS.inc(len(rows), kind='message_log')
+
+message_log = None
+if os.environ.get('MESSAGE_LOG', '1') != '0':
+    message_log = MessageLogWriter(_insert_messages,
+                                   maxsize=int(os.environ.get('MESSAGE_LOG_QUEUE_SIZE', 10000)),
+                                   batch_size=int(os.environ.get('MESSAGE_LOG_BATCH_SIZE', 500)),
+                                   policy=os.environ.get('MESSAGE_LOG_FULL_POLICY', 'drop'))
+
+def log_exchange(user, messages, response_text):
+    """Ставит в очередь последний вопрос пользователя и ответ модели."""
+    if message_log is None:
+        return
+    # Время фиксируем сейчас, а не при вставке: пачка может уйти в БД на секунду позже
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    last_user = next((msg for msg in reversed(messages or []) if msg.get('role') == 'user'), None)
+    if last_user is not None:
+        content = last_user.get('content')
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        message_log.enqueue({"user_api_key": user.api_key, "role": "user", "content": content, "timestamp": now})
+    message_log.enqueue({"user_api_key": user.api_key, "role": "assistant", "content": response_text, "timestamp": now})
+
+
+# --- КЭШ ОТВЕТОВ (включается через COMPLETION_CACHE=memory|sqlite) ---
+completion_cache = make_cache(os.environ.get('COMPLETION_CACHE', 'off').lower(), basedir)
+
+# --- СЕМАНТИЧЕСКИЙ КЭШ (SEMANTIC_CACHE=bruteforce|lsh, порог - SEMANTIC_CACHE_THRESHOLD[S]) ---
+# Отвечает из кэша на похожий вопрос при той же предыдущей переписке. Отключается в запросе через "cache": false.
+semantic_cache = make_semantic_cache(os.environ.get('SEMANTIC_CACHE', 'off').lower())
+if semantic_cache is not None:
+    CallbackGauge('llm_proxy_semantic_cache_size', 'Answers held in the semantic cache',
+                  lambda: {(alias,): stats["size"] for alias, stats in semantic_cache.stats().items()}, ('model',))
+
+# --- ОБЪЕДИНЕНИЕ ОДИНАКОВЫХ ЗАПРОСОВ (отключается SINGLE_FLIGHT=0) ---
+# Одинаковые запросы, пришедшие одновременно, идут к провайдеру один раз.
+# Лимит при этом списывается с каждого пользователя отдельно.
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', '1') != '0'
+single_flight = SingleFlight()
+
+CallbackGauge('llm_proxy_single_flight_requests', 'Upstream calls made (leader) and requests served by joining one (shared)',
+              lambda: {('leader',): single_flight.leaders, ('shared',): single_flight.shared}, ('role',))
+CallbackGauge('llm_proxy_usage_pending_keys', 'API keys with message counts not yet flushed to the DB',
+              lambda: usage.stats()["pending_keys"])
+if message_log is not None:
+    CallbackGauge('llm_proxy_message_log_rows', 'Message log rows by state since start',
+                  lambda: {(state,): value for state, value in message_log.stats().items()}, ('state',))
+
+# --- ОГРАНИЧЕНИЕ ЧАСТОТЫ (RATE_LIMIT=memory|sqlite|off) ---
+# memory - у каждого воркера свои ведра; при нескольких воркерах gunicorn берите sqlite,
+# тогда лимиты общие (отдельный файл RATE_LIMIT_PATH, по умолчанию rate_limit.db).
+rate_limiter = make_rate_limiter(os.environ.get('RATE_LIMIT', 'memory').lower(), basedir)
+PLAN_RATE_LIMITS = {plan: RateLimits.from_plan(details) for plan, details in TARIFF_PLANS.items()}
+
+def _rate_limits(user):
+    return PLAN_RATE_LIMITS.get(user.plan, PLAN_RATE_LIMITS['free'])
+
+if rate_limiter is not None:
+    CallbackGauge('llm_proxy_rate_limit_in_flight', 'Requests currently holding a concurrency slot',
+                  lambda: rate_limiter.stats()["in_flight"])
+
+def _with_cache_header(response, status):
+    # Ошибки возвращаются кортежем (response, код) - их не помечаем
+    if status and isinstance(response, Response):
+        response.headers['X-Cache'] = status
+    return response
+
+
 @app.route('/v1/chat/completions', methods=['POST'])
 @require_api_key
 def chat_completions():
     user = g.user
 
+    # 1. Получаем запрос от интерфейса Open WebUI
+    request_data = request.json
+    model_id = request_data.get('model')
+    messages = request_data.get('messages')
+    stream = bool(request_data.get('stream', False))
+
+    # Ответ из кэша отдаем до проверки лимита: он не стоит нам запроса к провайдеру
+    cache_status = None
+    key = None
+    flight_key = None
+    model_config = model_mapping.current().get(model_id)
+    # Канонический хэш запроса нужен и кэшу, и объединению одинаковых запросов
+    request_hash = cache_key(model_id, model_config, messages, request_data) \
+        if model_config and (completion_cache is not None or SINGLE_FLIGHT) else None
+    if SINGLE_FLIGHT and request_hash:
+        flight_key = ('stream:' if stream else 'full:') + request_hash
+    if completion_cache is not None and model_config and is_cacheable(request_data):
+        key = request_hash
+        cached_text = completion_cache.get(key)
+        CACHE_EVENTS.inc(result='hit' if cached_text is not None else 'miss')
+        if cached_text is not None:
+            return _cached_response(user, messages, model_id, cached_text, stream, 'HIT')
+        cache_status = 'MISS'
+    # Дословного совпадения нет - ищем похожий вопрос
+    semantic_probe = None
+    # Только детерминированные запросы (temperature=0 или явный "cache": true), как и для точного кэша
+    if semantic_cache is not None and model_config and is_cacheable(request_data):
+        semantic_probe = semantic_cache.probe(model_id, messages, sampling_params(request_data))
+        if semantic_probe is not None:
+            cached_text, similarity = semantic_cache.get(semantic_probe)
+            SEMANTIC_EVENTS.inc(model=model_id, result='hit' if cached_text is not None else 'miss')
+            if similarity is not None:
+                SEMANTIC_SIMILARITY.observe(similarity, model=model_id)
+            if cached_text is not None:
+                return _cached_response(user, messages, model_id, cached_text, stream, 'SEMANTIC')
+            cache_status = 'MISS'
+
+    def remember(response_text):
+        # Полностью полученный ответ кладем в оба кэша
+        if key is not None:
+            completion_cache.set(key, response_text)
+        if semantic_probe is not None:
+            semantic_cache.set(semantic_probe, response_text)
+
     # --- ИЗМЕНЕНИЕ НАЧИНАЕТСЯ ЗДЕСЬ ---
-    if user.message_count >= user.message_limit:
+    # Резервируем сообщение и оценку токенов (вопрос + max_tokens ответа) одной атомарной операцией в памяти.
+    # После ответа резерв заменяется фактическим расходом (usage.settle).
+    family = tokens.model_family(model_config['backends'][0]) if model_config and model_config.get('backends') else 'generic'
+    prompt_tokens = tokens.count_messages(messages, family)
+    reserved_tokens = prompt_tokens + _max_tokens(request_data)
+
+    reason = usage.reserve(user, reserved_tokens)
+    if reason is not None:
+        QUOTA_REJECTIONS.inc(reason=reason)
         # Вместо ошибки 429, мы формируем успешный ответ с предложением обновиться.
-        
-        # Генерируем полную ссылку на страницу профиля пользователя.
-        # _external=True добавляет домен и порт (http://127.0.0.1:8088/profile)
-        payment_url = url_for('profile', _external=True)
-
-        # Создаем текст сообщения с использованием Markdown для красивой ссылки.
-        response_text = (
-            "**Лимит сообщений исчерпан!** 😢\n\n"
-            "На вашем текущем тарифе закончились доступные сообщения. "
-            "Чтобы продолжить общение без ограничений, пожалуйста, обновите ваш тарифный план.\n\n"
-            f"👉 **[Перейти к выбору тарифа]({payment_url})**"
-        )
-        
-        # Собираем JSON-ответ, который выглядит как обычный ответ от модели.
         # Интерфейс Open WebUI покажет это как сообщение в чате.
-        limit_exceeded_response = {
-            "id": f"chatcmpl-limit-{uuid.uuid4()}",
-            "object": "chat.completion",
-            "created": int(time.time()),
-            "model": request.json.get('model', 'system-notification'),
-            "choices": [{
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": response_text
-                },
-                "finish_reason": "stop"
-            }],
-            "usage": {
-                "prompt_tokens": 0,
-                "completion_tokens": 0,
-                "total_tokens": 0
-            }
-        }
-        return jsonify(limit_exceeded_response)
-    # --- ИЗМЕНЕНИЕ ЗАКАНЧИВАЕТСЯ ЗДЕСЬ ---
+        response_text = _limit_message(reason)
+        completion_id = f"chatcmpl-limit-{uuid.uuid4()}"
+        notification_model = request_data.get('model', 'system-notification')
+        if stream:
+            return _sse_response(_stream_static_text(completion_id, notification_model, response_text))
+        return jsonify(_completion_response(completion_id, notification_model, response_text))
 
+    # Ограничение частоты - после проверки тарифа: отказ по тарифу не тратит rpm/tpm, а исчерпавший
+    # тариф пользователь получает сообщение о тарифе, а не 429. Ответ из кэша выше ведра не тратит,
+    # остальные занимают слот до конца ответа
+    if rate_limiter is not None:
+        try:
+            slot = rate_limiter.acquire(user.api_key, _rate_limits(user), reserved_tokens)
+        except RateLimited as e:
+            RATE_LIMITED.inc(plan=user.plan, reason=e.reason)
+            # В ведрах ничего не списано, возвращаем только резерв тарифа
+            _release_reservation(user, reserved_tokens, rate_limited=False)
+            return jsonify({"error": f"Rate limit exceeded ({e.reason}) for plan '{user.plan}', please retry later."}), 429, \
+                {'Retry-After': str(max(1, math.ceil(e.retry_after)))}
 
-    # 1. Получаем запрос от интерфейса Open WebUI (этот блок без изменений)
-    request_data = request.json
-    model_id = request_data.get('model')
-    messages = request_data.get('messages')
+        @after_this_request
+        def _release_slot(response):
+            # Для потоковых ответов call_on_close сработает, когда поток закончится или клиент отключится
+            response.call_on_close(lambda: rate_limiter.release(slot))
+            return response
+    # --- ИЗМЕНЕНИЕ ЗАКАНЧИВАЕТСЯ ЗДЕСЬ ---
 
-    model_config = MODEL_MAPPING.get(model_id)
     if not model_config:
+        _release_reservation(user, reserved_tokens)
+        # Имя модели прислал клиент - в метку его не берем, иначе число рядов метрики не ограничено
+        COMPLETION_ERRORS.inc(model='unknown', error='model_not_found')
         return jsonify({"error": f"Model '{model_id}' not found"}), 404
 
-    # 2. Отправляем запрос настоящему провайдеру (этот блок без изменений)
-    response_text = ""
-    try:
-        headers = {'Authorization': f'Bearer {model_config["api_key"]}', 'Content-Type': 'application/json'}
-        
-        if model_config["provider"] == "google":
-            google_payload = {"contents": [{"parts": [{"text": msg["content"]}] for msg in messages if msg['role'] == 'user'}]}
-            response = requests.post(model_config["provider_url"], headers=headers, json=google_payload)
-            response.raise_for_status()
-            response_text = response.json()["candidates"][0]["content"]["parts"][0]["text"]
-        
-        else: # provider == "openai"
-            payload = {"model": model_config["real_model"], "messages": messages}
-            response = requests.post(model_config["provider_url"], headers=headers, json=payload)
-            response.raise_for_status()
-            response_text = response.json()["choices"][0]["message"]["content"]
+    if stream:
+        return _with_cache_header(_stream_chat_completion(user, model_id, model_config, messages, remember, flight_key,
+                                                          prompt_tokens, reserved_tokens, family), cache_status)
 
+    # 2. Отправляем запрос настоящему провайдеру (пул сам переключится на другой бэкенд при 429/5xx)
+    def fetch():
+        return get_pool(model_id, model_config).call(lambda backend: call_provider(backend, messages))[1]
+    try:
+        response_text, upstream_usage = single_flight.do(flight_key, fetch) if flight_key else fetch()
     except requests.exceptions.RequestException as e:
+        _release_reservation(user, reserved_tokens)
+        COMPLETION_ERRORS.inc(model=model_id, error='upstream')
         print(f"ОШИБКА: Не удалось связаться с API провайдера: {e}")
-        return jsonify({"error": "Failed to get response from the underlying model provider."}), 500
+        return _upstream_error_response(e)
     except (KeyError, IndexError) as e:
+        _release_reservation(user, reserved_tokens)
+        COMPLETION_ERRORS.inc(model=model_id, error='parse')
         print(f"ОШИБКА: Не удалось разобрать ответ от API провайдера: {e}")
         return jsonify({"error": "Invalid response format from the underlying model provider."}), 500
+    except Exception:
+        # Любая другая ошибка (например, в сборке запроса к провайдеру): ответа нет - резерв возвращаем,
+        # иначе фоновая запись засчитает пользователю сообщение и токены
+        _release_reservation(user, reserved_tokens)
+        COMPLETION_ERRORS.inc(model=model_id, error='internal')
+        raise
 
-    # Увеличиваем счетчик и сохраняем в БД (этот блок без изменений)
-    user.message_count += 1
-    db.session.commit()
+    UPSTREAM_TTFB.observe(time.perf_counter() - g.request_started, model=model_id, stream='false')
+    # Сообщение уже зарезервировано в usage, в БД оно уйдет следующей пачкой
 
-    # Формируем финальный успешный ответ (этот блок без изменений)
-    final_response = {
-        "id": f"chatcmpl-{uuid.uuid4()}",
-        "object": "chat.completion",
-        "created": int(time.time()),
-        "model": model_id,
-        "choices": [{
-            "index": 0,
-            "message": {
-                "role": "assistant",
-                "content": response_text.strip()
-            },
-            "finish_reason": "stop"
-        }],
-        "usage": {
-            "prompt_tokens": 0,
-            "completion_tokens": 0,
-            "total_tokens": 0
-        }
+    # Формируем финальный успешный ответ
+    response_text = response_text.strip()
+    charged = _charge_tokens(user, model_id, reserved_tokens, prompt_tokens, response_text, upstream_usage, family)
+    remember(response_text)
+    log_exchange(user, messages, response_text)
+    return _with_cache_header(jsonify(_completion_response(f"chatcmpl-{uuid.uuid4()}", model_id, response_text, charged)), cache_status)
+
+
+def _cached_response(user, messages, model_id, cached_text, stream, cache_status):
+    # Ответ из кэша не тратит лимит тарифа, но попадает в историю сообщений
+    log_exchange(user, messages, cached_text)
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    if stream:
+        return _with_cache_header(_sse_response(_stream_static_text(completion_id, model_id, cached_text)), cache_status)
+    return _with_cache_header(jsonify(_completion_response(completion_id, model_id, cached_text)), cache_status)
+
+
+def _max_tokens(request_data):
+    # Верхняя граница ответа, если клиент ее задал; иначе резервируем только вопрос
+    value = request_data.get('max_completion_tokens', request_data.get('max_tokens'))
+    try:
+        return max(0, int(value)) if value is not None else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def _limit_message(reason):
+    # Генерируем полную ссылку на страницу профиля пользователя.
+    # _external=True добавляет домен и порт (http://127.0.0.1:8088/profile).
+    # Если личный кабинет работает в другом процессе (APP_COMPONENTS без web) - ссылка на YOUR_DOMAIN
+    payment_url = url_for('web_ui.profile', _external=True) if 'web_ui' in app.blueprints else f"{YOUR_DOMAIN}/profile"
+    if reason == 'message_limit':
+        title = "**Лимит сообщений исчерпан!** 😢"
+        details = "На вашем текущем тарифе закончились доступные сообщения."
+    elif reason == 'token_limit':
+        title = "**Лимит токенов исчерпан!** 😢"
+        details = "На вашем текущем тарифе закончились доступные токены."
+    else:
+        title = "**Запрос слишком большой для остатка лимита!** 😢"
+        details = "Оставшихся на тарифе токенов не хватает на этот запрос. Сократите историю диалога или max_tokens."
+    # Создаем текст сообщения с использованием Markdown для красивой ссылки.
+    return (
+        f"{title}\n\n{details} "
+        "Чтобы продолжить общение без ограничений, пожалуйста, обновите ваш тарифный план.\n\n"
+        f"👉 **[Перейти к выбору тарифа]({payment_url})**"
+    )
+
+
+def _release_reservation(user, reserved_tokens, rate_limited=True):
+    # Запрос к модели не удался - возвращаем и лимит тарифа, и токены из минутного ведра
+    usage.release(user, reserved_tokens)
+    if rate_limited and rate_limiter is not None:
+        rate_limiter.settle(user.api_key, _rate_limits(user), -reserved_tokens)
+
+
+def _charge_tokens(user, model_id, reserved_tokens, prompt_tokens, response_text, upstream_usage, family,
+                   rate_limited=True):
+    # Фактический расход: числа провайдера, если он их прислал, иначе локальный подсчет
+    if upstream_usage:
+        source = 'provider'
+        prompt_tokens = upstream_usage['prompt_tokens']
+        completion_tokens = upstream_usage['completion_tokens']
+    else:
+        source = 'local'
+        completion_tokens = tokens.count_text(response_text, family)
+    usage.settle(user, reserved_tokens, prompt_tokens + completion_tokens)
+    if rate_limited and rate_limiter is not None:
+        rate_limiter.settle(user.api_key, _rate_limits(user), prompt_tokens + completion_tokens - reserved_tokens)
+    TOKENS.inc(prompt_tokens, model=model_id, kind='prompt', source=source)
+    TOKENS.inc(completion_tokens, model=model_id, kind='completion', source=source)
+    return _usage_dict(prompt_tokens, completion_tokens)
+
+
+def _upstream_error_response(error):
+    # Если все бэкенды ответили 429 - так и говорим клиенту, а не маскируем под 500
+    response = getattr(error, 'response', None)
+    if response is not None and response.status_code == 429:
+        wait = retry_after(error)
+        return jsonify({"error": "The underlying model provider is rate limited, please retry later."}), 429, \
+            {'Retry-After': str(max(1, int(wait or 0)))}
+    return jsonify({"error": "Failed to get response from the underlying model provider."}), 500
+
+
+def _stream_chat_completion(user, model_id, model_config, messages, remember=None, flight_key=None,
+                            prompt_tokens=0, reserved_tokens=0, family='generic'):
+    # Соединение с провайдером открываем до начала ответа клиенту,
+    # чтобы ошибки подключения по-прежнему возвращались обычным JSON с кодом 500,
+    # а переключение на другой бэкенд происходило до первого байта ответа.
+    pool = get_pool(model_id, model_config)
+
+    def open_stream():
+        backend, upstream = pool.call(lambda backend: open_provider_stream(backend, messages))
+        def pieces():
+            try:
+                yield from iter_provider_stream(backend.config, upstream)
+            except requests.exceptions.RequestException as e:
+                pool.report_failure(backend, e)
+                raise
+        return pieces(), upstream.close
+
+    try:
+        # Одинаковые одновременные потоки читают один ответ провайдера; закрытие
+        # соединения с провайдером произойдет, когда отключится последний из клиентов.
+        # Без flight_key поток просто ни с кем не делится.
+        stream_pieces = single_flight.stream(flight_key, open_stream)
+    except requests.exceptions.RequestException as e:
+        _release_reservation(user, reserved_tokens)
+        COMPLETION_ERRORS.inc(model=model_id, error='upstream')
+        print(f"ОШИБКА: Не удалось связаться с API провайдера: {e}")
+        return _upstream_error_response(e)
+    except Exception:
+        _release_reservation(user, reserved_tokens)
+        COMPLETION_ERRORS.inc(model=model_id, error='internal')
+        raise
+
+    completion_id = f"chatcmpl-{uuid.uuid4()}"
+    request_started = g.request_started
+
+    def generate():
+        delivered = False
+        pieces = []
+        upstream_usage = None
+        charged = False
+        try:
+            yield _sse(_completion_chunk(completion_id, model_id, {"role": "assistant", "content": ""}))
+            for text in stream_pieces:
+                if isinstance(text, dict):
+                    # Последним элементом провайдер может прислать расход токенов
+                    upstream_usage = text
+                    continue
+                if not delivered:
+                    UPSTREAM_TTFB.observe(time.perf_counter() - request_started, model=model_id, stream='true')
+                delivered = True
+                pieces.append(text)
+                yield _sse(_completion_chunk(completion_id, model_id, {"content": text}))
+            # В кэш кладем только полностью полученный ответ
+            if remember is not None and delivered:
+                remember("".join(pieces).strip())
+            final_chunk = _completion_chunk(completion_id, model_id, {}, finish_reason="stop")
+            if delivered:
+                final_chunk["usage"] = _charge_tokens(user, model_id, reserved_tokens, prompt_tokens,
+                                                      "".join(pieces).strip(), upstream_usage, family)
+                charged = True
+            yield _sse(final_chunk)
+            yield "data: [DONE]\n\n"
+        except requests.exceptions.RequestException as e:
+            COMPLETION_ERRORS.inc(model=model_id, error='stream_interrupted')
+            print(f"ОШИБКА: Поток от API провайдера прервался: {e}")
+            yield _sse({"error": {"message": "Stream from the underlying model provider was interrupted."}})
+        except (ValueError, KeyError, IndexError) as e:
+            COMPLETION_ERRORS.inc(model=model_id, error='parse')
+            print(f"ОШИБКА: Не удалось разобрать поток от API провайдера: {e}")
+            yield _sse({"error": {"message": "Invalid stream format from the underlying model provider."}})
+        finally:
+            # Сюда попадаем и при обычном завершении, и при отключении клиента (GeneratorExit):
+            # закрываем соединение с провайдером, чтобы он прекратил генерацию.
+            stream_pieces.close()
+            # Сообщение засчитываем один раз в конце потока, если модель успела что-то ответить
+            if not delivered:
+                _release_reservation(user, reserved_tokens)
+            else:
+                if not charged:
+                    # Поток оборвался до конца - списываем то, что клиент успел получить
+                    _charge_tokens(user, model_id, reserved_tokens, prompt_tokens,
+                                   "".join(pieces).strip(), upstream_usage, family)
+                log_exchange(user, messages, "".join(pieces).strip())
+
+    return _sse_response(generate())
+
+# --- ПАКЕТНОЕ ВЫПОЛНЕНИЕ (/v1/files, /v1/batches, /v1/chat/completions/batch) ---
+def _batch_user(api_key):
+    user = auth_cache.get(api_key)
+    if user is None:
+        with app.app_context():
+            db_user = User.query.filter_by(api_key=api_key).first()
+            if db_user is None:
+                return None
+            user = auth_cache.put(api_key, CachedUser.from_model(db_user))
+    return user
+
+def _complete_for_batch(api_key, request_data, rate_limited=False):
+    """Один запрос пакета без потоковой передачи. Возвращает (код, тело) как у /v1/chat/completions,
+    ошибки провайдера пробрасывает - повторы и паузы решает BatchRunner.
+    rate_limited - тратить минутные ведра ключа (синхронный пакет); очередь /v1/batches их не тратит."""
+    user = _batch_user(api_key)
+    if user is None:
+        return 403, {"error": {"message": "Invalid API key", "code": "invalid_api_key"}}
+    model_id = request_data.get('model')
+    messages = request_data.get('messages')
+    model_config = model_mapping.current().get(model_id)
+    if not model_config or not model_config.get('backends'):
+        return 404, {"error": {"message": f"Model '{model_id}' not found", "code": "model_not_found"}}
+
+    key = None
+    if completion_cache is not None and is_cacheable(request_data):
+        key = cache_key(model_id, model_config, messages, request_data)
+        cached_text = completion_cache.get(key)
+        CACHE_EVENTS.inc(result='hit' if cached_text is not None else 'miss')
+        if cached_text is not None:
+            log_exchange(user, messages, cached_text)
+            return 200, _completion_response(f"chatcmpl-{uuid.uuid4()}", model_id, cached_text)
+
+    family = tokens.model_family(model_config['backends'][0])
+    prompt_tokens = tokens.count_messages(messages, family)
+    reserved_tokens = prompt_tokens + _max_tokens(request_data)
+    # Пакеты расходуют тот же лимит тарифа; минутные ведра - только синхронные, темп очереди задают ProviderGates
+    reason = usage.reserve(user, reserved_tokens)
+    if reason is not None:
+        QUOTA_REJECTIONS.inc(reason=reason)
+        return 429, {"error": {"message": "The usage limit of the current plan is exhausted.", "code": reason}}
+    if rate_limited and rate_limiter is not None:
+        limits = _rate_limits(user)
+        try:
+            # Слот одновременных запросов на весь пакет держит chat_completions_batch, здесь - только rpm и tpm
+            rate_limiter.acquire(user.api_key, RateLimits(limits.rpm, limits.tpm), reserved_tokens)
+        except RateLimited as e:
+            RATE_LIMITED.inc(plan=user.plan, reason=e.reason)
+            _release_reservation(user, reserved_tokens, rate_limited=False)
+            return 429, {"error": {"message": f"Rate limit exceeded ({e.reason}) for plan '{user.plan}', please retry later.",
+                                   "code": e.reason}}
+    try:
+        response_text, upstream_usage = get_pool(model_id, model_config).call(
+            lambda backend: call_provider(backend, messages))[1]
+    except requests.exceptions.RequestException:
+        _release_reservation(user, reserved_tokens, rate_limited=rate_limited)
+        COMPLETION_ERRORS.inc(model=model_id, error='upstream')
+        raise
+    except (KeyError, IndexError) as e:
+        _release_reservation(user, reserved_tokens, rate_limited=rate_limited)
+        COMPLETION_ERRORS.inc(model=model_id, error='parse')
+        print(f"ОШИБКА: Не удалось разобрать ответ от API провайдера: {e}")
+        return 502, {"error": {"message": "Invalid response format from the underlying model provider.", "code": "parse"}}
+    except Exception:
+        _release_reservation(user, reserved_tokens, rate_limited=rate_limited)
+        COMPLETION_ERRORS.inc(model=model_id, error='internal')
+        raise
+
+    response_text = response_text.strip()
+    charged = _charge_tokens(user, model_id, reserved_tokens, prompt_tokens, response_text, upstream_usage, family,
+                             rate_limited=rate_limited)
+    if key is not None:
+        completion_cache.set(key, response_text)
+    log_exchange(user, messages, response_text)
+    return 200, _completion_response(f"chatcmpl-{uuid.uuid4()}", model_id, response_text, charged)
+
+def _batch_gate(request_data):
+    # Ключ семафора - хосты провайдеров, на которых живет модель. Не backend['provider']:
+    # это формат API, и у Groq он тот же 'openai', что и у OpenAI
+    config = model_mapping.current().get(request_data.get('model')) or {}
+    return ",".join(sorted({urlsplit(backend['provider_url']).hostname or '' for backend in config.get('backends', [])})) or 'unknown'
+
+def _claim_batch_requests(limit):
+    # Один UPDATE забирает пачку атомарно, поэтому несколько воркеров не возьмут один запрос дважды
+    token = uuid.uuid4().hex
+    now = time.time()
+    with app.app_context():
+        # Сначала чтение: в режиме WAL оно не берет блокировку записи, и пустая очередь ее не занимает
+        ready = db.session.execute(text("SELECT 1 FROM batch_requests WHERE status = 'pending' AND not_before <= :now LIMIT 1"),
+                                   {"now": now}).first()
+        db.session.rollback()
+        if ready is None:
+            return []
+        db.session.execute(text(
+            "UPDATE batch_requests SET status = 'running', claimed_by = :token, claimed_at = :now, attempts = attempts + 1 "
+            "WHERE id IN (SELECT id FROM batch_requests WHERE status = 'pending' AND not_before <= :now "
+            "ORDER BY id LIMIT :limit)"), {"token": token, "now": now, "limit": limit})
+        rows = db.session.execute(text(
+            "SELECT r.id, b.user_api_key, r.body, r.attempts FROM batch_requests r JOIN batches b ON b.id = r.batch_id "
+            "WHERE r.claimed_by = :token AND r.status = 'running'"), {"token": token}).fetchall()
+        db.session.commit()
+    return [{"id": row[0], "api_key": row[1], "body": json.loads(row[2]), "attempts": row[3]} for row in rows]
+
+def _finish_batch_request(request_id, status_code, body):
+    with app.app_context():
+        batch_id = db.session.execute(text("SELECT batch_id FROM batch_requests WHERE id = :id"),
+                                      {"id": request_id}).scalar()
+        db.session.execute(text(
+            "UPDATE batch_requests SET status = :status, status_code = :code, response = :response, claimed_by = NULL "
+            "WHERE id = :id AND status = 'running'"),
+            {"id": request_id, "status": 'done' if status_code < 400 else 'failed', "code": status_code,
+             "response": json.dumps(body, ensure_ascii=False)})
+        db.session.commit()
+    _finalize_batch(batch_id)
+
+# Запрос, вернувшийся в очередь отмененного пакета, сразу помечаем отмененным
+_REQUEUE_STATUS = ("CASE WHEN (SELECT status FROM batches WHERE batches.id = batch_requests.batch_id) = 'cancelling' "
+                   "THEN 'cancelled' ELSE 'pending' END")
+
+def _retry_batch_request(request_id, delay):
+    with app.app_context():
+        batch_id = db.session.execute(text("SELECT batch_id FROM batch_requests WHERE id = :id"),
+                                      {"id": request_id}).scalar()
+        db.session.execute(text(
+            f"UPDATE batch_requests SET status = {_REQUEUE_STATUS}, claimed_by = NULL, not_before = :not_before "
+            "WHERE id = :id AND status = 'running'"), {"id": request_id, "not_before": time.time() + delay})
+        db.session.commit()
+    _finalize_batch(batch_id)
+
+def _reclaim_batch_requests():
+    with app.app_context():
+        reclaimed = db.session.execute(text(
+            f"UPDATE batch_requests SET status = {_REQUEUE_STATUS}, claimed_by = NULL "
+            "WHERE status = 'running' AND claimed_at < :cutoff"), {"cutoff": time.time() - batches.CLAIM_TTL}).rowcount
+        db.session.commit()
+        cancelling = [row[0] for row in db.session.execute(text(
+            "SELECT id FROM batches WHERE status = 'cancelling' AND finalizing_at IS NULL")).fetchall()]
+    if reclaimed:
+        print(f"ВНИМАНИЕ: {reclaimed} брошенных запросов пакетов возвращены в очередь")
+    for batch_id in cancelling:
+        _finalize_batch(batch_id)
+
+def _batch_output_line(row):
+    line = {"id": f"batch_req_{row.id}", "custom_id": row.custom_id, "response": None, "error": None}
+    body = json.loads(row.response) if row.response else None
+    if row.status_code is not None:
+        line["response"] = {"status_code": row.status_code, "request_id": f"req_{row.id}", "body": body}
+    if row.status == 'cancelled':
+        line["error"] = {"code": "batch_cancelled", "message": "The batch was cancelled before this request ran."}
+    elif row.status == 'failed':
+        error = body.get('error') if isinstance(body, dict) else None
+        line["error"] = error if isinstance(error, dict) else {"code": "failed", "message": str(error)}
+    return line
+
+def _finalize_batch(batch_id):
+    """Собирает файлы результатов, когда в пакете не осталось невыполненных запросов."""
+    with app.app_context():
+        remaining = db.session.execute(text(
+            "SELECT COUNT(*) FROM batch_requests WHERE batch_id = :id AND status IN ('pending', 'running')"),
+            {"id": batch_id}).scalar()
+        if remaining:
+            return
+        now = int(time.time())
+        # Финализирует только тот поток (и воркер), который первым поставил finalizing_at
+        claimed = db.session.execute(text(
+            "UPDATE batches SET finalizing_at = :now WHERE id = :id AND finalizing_at IS NULL"),
+            {"id": batch_id, "now": now}).rowcount
+        if claimed != 1:
+            db.session.rollback()
+            return
+        batch = db.session.get(Batch, batch_id)
+        output, errors = [], []
+        for row in BatchRequest.query.filter_by(batch_id=batch_id).order_by(BatchRequest.line).yield_per(500):
+            line = json.dumps(_batch_output_line(row), ensure_ascii=False)
+            (output if row.status == 'done' else errors).append(line)
+        if output:
+            batch.output_file_id = _new_file(batch.user_api_key, 'batch_output', f"{batch_id}_output.jsonl", output).id
+        if errors:
+            batch.error_file_id = _new_file(batch.user_api_key, 'batch_output', f"{batch_id}_errors.jsonl", errors).id
+        if batch.status == 'cancelling':
+            batch.status, batch.cancelled_at = 'cancelled', now
+        else:
+            batch.status, batch.completed_at = 'completed', now
+        db.session.commit()
+
+batch_runner = BatchRunner(_complete_for_batch, _batch_gate, _claim_batch_requests, _finish_batch_request,
+                           _retry_batch_request, _reclaim_batch_requests)
+CallbackGauge('llm_proxy_batch_active_requests', 'Batch requests currently running in this worker',
+              lambda: batch_runner.stats()["active"])
+
+_batches_checked = False
+
+def _resume_batches_once():
+    # Фоновый опрос очереди запускается, только когда пакеты есть: при создании пакета
+    # или если после перезапуска воркера в базе остались незаконченные запросы
+    global _batches_checked
+    if _batches_checked:
+        return
+    _batches_checked = True
+    try:
+        unfinished = db.session.execute(text("SELECT 1 FROM batch_requests WHERE status IN ('pending', 'running') LIMIT 1")).first()
+    except Exception as e:
+        print(f"ОШИБКА: Не удалось проверить незаконченные пакеты: {e}")
+        unfinished = None
+    db.session.rollback()
+    if unfinished is not None:
+        batch_runner.ensure_started()
+
+def _new_file(api_key, purpose, filename, lines):
+    content = lines if isinstance(lines, str) else "\n".join(lines) + "\n"
+    batch_file = BatchFile(id=f"file-{uuid.uuid4().hex}", user_api_key=api_key, purpose=purpose, filename=filename,
+                           bytes=len(content.encode('utf-8')), content=content, created_at=int(time.time()))
+    db.session.add(batch_file)
+    return batch_file
+
+def _file_object(batch_file):
+    return {"id": batch_file.id, "object": "file", "bytes": batch_file.bytes, "created_at": batch_file.created_at,
+            "filename": batch_file.filename, "purpose": batch_file.purpose}
+
+def _batch_counts(batch_id):
+    counts = dict(db.session.execute(text(
+        "SELECT status, COUNT(*) FROM batch_requests WHERE batch_id = :id GROUP BY status"), {"id": batch_id}).fetchall())
+    return {"total": sum(counts.values()), "completed": counts.get('done', 0),
+            "failed": counts.get('failed', 0) + counts.get('cancelled', 0)}
+
+def _batch_object(batch):
+    return {
+        "id": batch.id, "object": "batch", "endpoint": batch.endpoint, "errors": None,
+        "input_file_id": batch.input_file_id, "completion_window": batch.completion_window, "status": batch.status,
+        "output_file_id": batch.output_file_id, "error_file_id": batch.error_file_id,
+        "created_at": batch.created_at, "in_progress_at": batch.created_at, "finalizing_at": batch.finalizing_at,
+        "completed_at": batch.completed_at, "cancelled_at": batch.cancelled_at,
+        "request_counts": _batch_counts(batch.id),
+        "metadata": json.loads(batch.metadata_json) if batch.metadata_json else None,
     }
 
-    return jsonify(final_response)
+@app.route('/v1/files', methods=['POST'])
+@require_api_key
+def upload_file():
+    upload = request.files.get('file')
+    if upload is None or request.form.get('purpose') != 'batch':
+        return jsonify({"error": "Expected multipart field 'file' and purpose=batch"}), 400
+    raw = upload.read(batches.FILE_MAX_BYTES + 1)
+    if len(raw) > batches.FILE_MAX_BYTES:
+        return jsonify({"error": f"File is larger than {batches.FILE_MAX_BYTES} bytes"}), 413
+    try:
+        content = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return jsonify({"error": "File must be UTF-8 encoded JSONL"}), 400
+    batch_file = _new_file(g.user.api_key, 'batch', upload.filename or 'input.jsonl', content)
+    db.session.commit()
+    return jsonify(_file_object(batch_file))
+
+def _user_file(file_id):
+    batch_file = db.session.get(BatchFile, file_id) if file_id else None
+    return batch_file if batch_file is not None and batch_file.user_api_key == g.user.api_key else None
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+@require_api_key
+def get_file(file_id):
+    batch_file = _user_file(file_id)
+    if batch_file is None:
+        return jsonify({"error": f"File '{file_id}' not found"}), 404
+    return jsonify(_file_object(batch_file))
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+@require_api_key
+def get_file_content(file_id):
+    batch_file = _user_file(file_id)
+    if batch_file is None:
+        return jsonify({"error": f"File '{file_id}' not found"}), 404
+    return Response(batch_file.content, mimetype='application/jsonl')
+
+@app.route('/v1/batches', methods=['POST'])
+@require_api_key
+def create_batch():
+    data = request.get_json(silent=True) or {}
+    endpoint = data.get('endpoint')
+    if endpoint != '/v1/chat/completions':
+        return jsonify({"error": "Only endpoint '/v1/chat/completions' is supported"}), 400
+    if data.get('completion_window', '24h') != '24h':
+        return jsonify({"error": "Only completion_window '24h' is supported"}), 400
+    input_file = _user_file(data.get('input_file_id'))
+    if input_file is None:
+        return jsonify({"error": f"File '{data.get('input_file_id')}' not found"}), 404
+    try:
+        items = batches.parse_input_file(input_file.content, endpoint)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid input file: {e}"}), 400
+
+    batch = Batch(id=f"batch_{uuid.uuid4().hex}", user_api_key=g.user.api_key, endpoint=endpoint,
+                  input_file_id=input_file.id, completion_window='24h', status='in_progress',
+                  metadata_json=json.dumps(data['metadata'], ensure_ascii=False) if data.get('metadata') else None,
+                  created_at=int(time.time()))
+    db.session.add(batch)
+    db.session.flush()
+    # Все строки одной вставкой (executemany) в той же транзакции, что и сам пакет
+    db.session.execute(BatchRequest.__table__.insert(), [
+        {"batch_id": batch.id, "line": line, "custom_id": custom_id, "body": json.dumps(body, ensure_ascii=False),
+         "status": 'pending', "attempts": 0, "not_before": 0}
+        for line, (custom_id, body) in enumerate(items)
+    ])
+    db.session.commit()
+    batch_runner.ensure_started()
+    batch_runner.wake()
+    return jsonify(_batch_object(batch))
+
+def _user_batch(batch_id):
+    batch = db.session.get(Batch, batch_id) if batch_id else None
+    return batch if batch is not None and batch.user_api_key == g.user.api_key else None
+
+@app.route('/v1/batches', methods=['GET'])
+@require_api_key
+def list_batches():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    query = Batch.query.filter_by(user_api_key=g.user.api_key)
+    after = _user_batch(request.args.get('after'))
+    if after is not None:
+        query = query.filter(db.or_(Batch.created_at < after.created_at,
+                                    db.and_(Batch.created_at == after.created_at, Batch.id < after.id)))
+    page = query.order_by(Batch.created_at.desc(), Batch.id.desc()).limit(limit + 1).all()
+    data = [_batch_object(batch) for batch in page[:limit]]
+    return jsonify({"object": "list", "data": data, "has_more": len(page) > limit,
+                    "first_id": data[0]["id"] if data else None, "last_id": data[-1]["id"] if data else None})
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+@require_api_key
+def get_batch(batch_id):
+    batch = _user_batch(batch_id)
+    if batch is None:
+        return jsonify({"error": f"Batch '{batch_id}' not found"}), 404
+    return jsonify(_batch_object(batch))
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+@require_api_key
+def cancel_batch(batch_id):
+    batch = _user_batch(batch_id)
+    if batch is None:
+        return jsonify({"error": f"Batch '{batch_id}' not found"}), 404
+    if batch.status == 'in_progress':
+        # Выполняющиеся запросы доработают, остальные отменяются сразу
+        batch.status = 'cancelling'
+        db.session.execute(text("UPDATE batch_requests SET status = 'cancelled' WHERE batch_id = :id AND status = 'pending'"),
+                           {"id": batch.id})
+        db.session.commit()
+        _finalize_batch(batch.id)
+        db.session.refresh(batch)
+    return jsonify(_batch_object(batch))
+
+@app.route('/v1/chat/completions/batch', methods=['POST'])
+@require_api_key
+def chat_completions_batch():
+    # Синхронный пакет: до BATCH_SYNC_MAX_REQUESTS запросов, ответы в том же порядке
+    data = request.get_json(silent=True) or {}
+    bodies = data.get('requests')
+    if not isinstance(bodies, list) or not bodies:
+        return jsonify({"error": "'requests' must be a non-empty list of chat completion bodies"}), 400
+    if len(bodies) > batches.SYNC_MAX_REQUESTS:
+        return jsonify({"error": f"Too many requests, the limit is {batches.SYNC_MAX_REQUESTS}; use /v1/batches"}), 400
+    for index, body in enumerate(bodies):
+        error = batches.validate_body(body)
+        if error:
+            return jsonify({"error": f"requests[{index}]: {error}"}), 400
+    # Весь пакет занимает один слот одновременных запросов, а rpm и tpm тратит каждый запрос пакета
+    # (_complete_for_batch): что не поместилось в ведра, получает свой 429
+    slot = None
+    if rate_limiter is not None:
+        try:
+            slot = rate_limiter.acquire(g.user.api_key, RateLimits(concurrency=_rate_limits(g.user).concurrency))
+        except RateLimited as e:
+            RATE_LIMITED.inc(plan=g.user.plan, reason=e.reason)
+            return jsonify({"error": f"Rate limit exceeded ({e.reason}) for plan '{g.user.plan}', please retry later."}), 429, \
+                {'Retry-After': str(max(1, math.ceil(e.retry_after)))}
+    try:
+        results = batch_runner.run_many(g.user.api_key, bodies, rate_limited=True)
+    finally:
+        if slot is not None:
+            rate_limiter.release(slot)
+    return jsonify({"object": "list",
+                    "data": [{"index": index, "status_code": status, "body": body}
+                             for index, (status, body) in enumerate(results)]})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # Если задан METRICS_TOKEN, Prometheus должен передавать его как Bearer-токен
+    metrics_token = os.environ.get('METRICS_TOKEN')
+    if metrics_token and request.headers.get('Authorization') != f"Bearer {metrics_token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
 
 @app.route('/v1/me', methods=['GET'])
 @require_api_key
@@ -225,18 +1045,6 @@ def get_current_user_info():
         "plan": user.plan
     })
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        api_key = request.form.get('api_key')
-        user = User.query.filter_by(api_key=api_key).first()
-        if user:
-            session['api_key'] = user.api_key # Запоминаем ключ в сессии
-            return redirect(url_for('profile'))
-        else:
-            return render_template('login.html', error="Неверный API ключ")
-    return render_template('login.html')
-
 @app.route('/api/internal/create_user', methods=['POST'])
 def create_internal_user():
     # Это наш "пароль" для связи между двумя сервисами.
@@ -260,89 +1068,19 @@ def create_internal_user():
     # Используем логику из вашего manage_users.py
     api_key = f"user-{uuid.uuid4().hex}"
     # Создаем пользователя с email в качестве username и лимитом по умолчанию (например, 200)
-    new_user = User(username=email, api_key=api_key, message_limit=200) 
+    new_user = User(username=email, api_key=api_key, message_limit=200, token_limit=TARIFF_PLANS['free']['token_limit']) 
     
     db.session.add(new_user)
     db.session.commit()
+    auth_cache.invalidate(api_key)
     
     print(f"Internal API: Successfully created user {email} with key {api_key}")
     
     # Возвращаем созданный ключ - это ОЧЕНЬ ВАЖНО для следующего шага
     return jsonify({"email": new_user.username, "api_key": new_user.api_key}), 201
 
-@app.route('/profile')
-def profile():
-    if 'api_key' not in session:
-        return redirect(url_for('login'))
-    
-    user = User.query.filter_by(api_key=session['api_key']).first()
-    if not user:
-        session.clear() # Ключ недействителен, чистим сессию
-        return redirect(url_for('login'))
-        
-    return render_template('profile.html', user=user, plans=TARIFF_PLANS)
-
-@app.route('/logout')
-def logout():
-    session.clear()
-    return redirect(url_for('login'))
-
-
-# --- НОВЫЕ РОУТЫ ДЛЯ ИНТЕГРАЦИИ С ОПЛАТОЙ ---
-
-@app.route('/create-checkout-session/<plan>')
-def create_checkout_session(plan):
-    if 'api_key' not in session:
-        return redirect(url_for('login'))
-    if plan not in TARIFF_PLANS:
-        return abort(404)
-        
-    try:
-        checkout_session = stripe.checkout.Session.create(
-            line_items=[{'price': TARIFF_PLANS[plan]['stripe_price_id'], 'quantity': 1}],
-            mode='payment',
-            success_url=YOUR_DOMAIN + '/profile?payment=success',
-            cancel_url=YOUR_DOMAIN + '/profile?payment=cancel',
-            # ВАЖНО: передаем ключ пользователя, чтобы знать, кого обновлять
-            client_reference_id=session['api_key'] 
-        )
-    except Exception as e:
-        return str(e)
-        
-    return redirect(checkout_session.url, code=303)
-
-@app.route('/stripe-webhook', methods=['POST'])
-def stripe_webhook():
-    payload = request.data
-    sig_header = request.headers.get('Stripe-Signature')
-    event = None
-
-    try:
-        event = stripe.Webhook.construct_event(payload, sig_header, stripe_webhook_secret)
-    except ValueError as e: # Неверный payload
-        return 'Invalid payload', 400
-    except stripe.error.SignatureVerificationError as e: # Неверная подпись
-        return 'Invalid signature', 400
-
-    # Обрабатываем событие checkout.session.completed
-    if event['type'] == 'checkout.session.completed':
-        session_data = event['data']['object']
-        api_key = session_data.get('client_reference_id')
-        # Тут может быть логика поиска плана по price_id, но для простоты мы найдем по api_key
-        user = User.query.get(api_key)
-        if user:
-            # Находим, какой план был куплен (в реальном проекте - по ID)
-            # Здесь для простоты обновим до 'pro'
-            new_plan = 'pro' # <-- В проде нужно определять по session_data
-            user.plan = new_plan
-            user.message_limit = TARIFF_PLANS[new_plan]['limit']
-            # Можно сбросить счетчик или добавить лимит к существующему
-            user.message_count = 0 
-            db.session.commit()
-            print(f"✅ Пользователь {user.username} успешно обновил тариф до {new_plan}")
-
-    return 'OK', 200
-
+if STARTUP_DIAGNOSTICS or __name__ == '__main__':
+    print_diagnostics()
 
 if __name__ == '__main__':
     with app.app_context():
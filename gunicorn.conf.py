@@ -0,0 +1,22 @@
+# gunicorn.conf.py
+# Настройки Gunicorn. Любое значение можно переопределить переменной окружения.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8088')
+
+# Почти все время запрос ждет ответа от провайдера (сеть, а не CPU),
+# поэтому потоков может быть много: один поток = один одновременный запрос к модели.
+# Пул соединений к провайдерам настраивается в upstream.py (UPSTREAM_POOL_SIZE).
+# SQLite работает в режиме WAL (см. custom_provider.py), поэтому воркеров может быть несколько.
+# Учтите: кэш пользователей у каждого воркера свой, и расход лимита, сделанный в соседнем
+# воркере, он увидит не позже чем через AUTH_CACHE_TTL секунд.
+# Ограничение частоты (RATE_LIMIT) по умолчанию тоже считается в памяти воркера -
+# при workers > 1 включите RATE_LIMIT=sqlite, чтобы лимиты rpm/tpm/concurrency были общими.
+worker_class = 'gthread'
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+
+# Для gthread это таймаут "зависшего" воркера, а не длительность запроса,
+# но держим его больше, чем UPSTREAM_READ_TIMEOUT, на случай долгих генераций
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 180))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
@@ -1,92 +1,329 @@
 # --- ФАЙЛ MANAGE_USERS.PY ---
+# Консольная утилита для управления пользователями. Схема таблиц - общая с сервером (models.py),
+# все массовые операции идут одной транзакцией через executemany, списки читаются страницами.
+#
+#   python manage_users.py add alice --plan pro
+#   python manage_users.py list --plan free
+#   python manage_users.py import users.csv --keys-out keys.csv
+#   python manage_users.py export users.jsonl
+#   python manage_users.py set-plan pro --users alice bob
+#   python manage_users.py set-limit --messages 500 --plan free
+#   python manage_users.py reset-counters --all
+#
+# Сервер кэширует пользователей (AUTH_CACHE_TTL, по умолчанию 60 секунд),
+# поэтому изменения лимитов и тарифов он увидит с этой задержкой.
 
-import sqlite3
+import os
+import sys
+import csv
+import json
 import argparse
 import secrets # Для генерации безопасных ключей
+from itertools import islice
 
+from sqlalchemy import create_engine, event, select, update, func, bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.sqlite import insert
+
+from models import db, TARIFF_PLANS, User
+
+basedir = os.path.abspath(os.path.dirname(__file__))
 DB_NAME = 'users.db'
+DB_PATH = os.environ.get('DATABASE_PATH', os.path.join(basedir, DB_NAME))
+
+# Сколько строк вставлять/читать за один раз: память не растет с размером файла или таблицы
+CHUNK_SIZE = 1000
+EXPORT_COLUMNS = ('api_key', 'username', 'plan', 'message_count', 'message_limit', 'token_count', 'token_limit')
+users = User.__table__
+
+
+def get_engine():
+    engine = create_engine('sqlite:///' + DB_PATH)
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+
+    return engine
+
+def setup_database(engine):
+    """Создает недостающие таблицы по общей схеме. Новые колонки в старой базе добавляет migrate.py."""
+    db.metadata.create_all(engine)
+    with engine.connect() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(users)")}
+    missing = [column.name for column in users.columns if column.name not in columns]
+    if missing:
+        sys.exit(f"❌ В таблице users нет колонок {', '.join(missing)}. Сначала запустите: python migrate.py")
+
+
+def new_api_key():
+    return f"user-{secrets.token_hex(16)}"
+
+def plan_limits(plan):
+    if plan not in TARIFF_PLANS:
+        sys.exit(f"❌ Неизвестный тариф '{plan}'. Доступны: {', '.join(TARIFF_PLANS)}")
+    return TARIFF_PLANS[plan]['limit'], TARIFF_PLANS[plan]['token_limit']
 
-def setup_database():
-    """Эта функция теперь живет и здесь, чтобы скрипт мог сам создать БД."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            api_key TEXT PRIMARY KEY,
-            username TEXT NOT NULL UNIQUE,
-            message_count INTEGER NOT NULL DEFAULT 0,
-            message_limit INTEGER NOT NULL
-        )
-    ''')
-    # Вторая таблица нам тут не нужна, она используется только основным сервером
-    conn.commit()
-    conn.close()
-
-def add_user(username, limit):
+def chunks(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def add_user(engine, username, limit=None, plan='free'):
     """Добавляет нового пользователя с уникальным ключом и лимитом."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
+    message_limit, token_limit = plan_limits(plan)
     # Генерируем новый, безопасный API-ключ
-    api_key = f"user-{secrets.token_hex(16)}"
-    
-    try:
-        cursor.execute(
-            "INSERT INTO users (api_key, username, message_limit) VALUES (?, ?, ?)",
-            (api_key, username, limit)
-        )
-        conn.commit()
-        print("="*50)
-        print(f"✅ Пользователь '{username}' успешно добавлен!")
-        print(f"   Лимит сообщений: {limit}")
-        print(f"   API Ключ: {api_key}")
-        print("="*50)
-    except sqlite3.IntegrityError:
+    api_key = new_api_key()
+    row = {"api_key": api_key, "username": username, "plan": plan,
+           "message_limit": limit if limit is not None else message_limit, "token_limit": token_limit}
+    with engine.begin() as conn:
+        inserted = conn.execute(insert(users).values(row).on_conflict_do_nothing()).rowcount
+    if not inserted:
         print(f"❌ Ошибка: Пользователь с именем '{username}' уже существует.")
-    finally:
-        conn.close()
-
-def list_users():
-    """Показывает список всех пользователей в базе."""
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT username, api_key, message_count, message_limit FROM users")
-    users = cursor.fetchall()
-    
-    if not users:
+        return
+    print("="*50)
+    print(f"✅ Пользователь '{username}' успешно добавлен!")
+    print(f"   Тариф: {plan}, лимит сообщений: {row['message_limit']}")
+    print(f"   API Ключ: {api_key}")
+    print("="*50)
+
+
+def iter_users(engine, plan=None, page_size=CHUNK_SIZE):
+    """Постранично (по возрастанию api_key) отдает пользователей, не загружая всю таблицу в память."""
+    after = None
+    while True:
+        query = select(*(users.c[name] for name in EXPORT_COLUMNS)).order_by(users.c.api_key).limit(page_size)
+        if plan:
+            query = query.where(users.c.plan == plan)
+        if after is not None:
+            query = query.where(users.c.api_key > after)
+        # Отдельная короткая транзакция на страницу: не держим чтение открытым, пока печатаем
+        with engine.connect() as conn:
+            page = [dict(row._mapping) for row in conn.execute(query)]
+        if not page:
+            return
+        yield from page
+        after = page[-1]['api_key']
+
+def list_users(engine, plan=None, page_size=CHUNK_SIZE):
+    """Показывает список пользователей в базе."""
+    count = 0
+    for user in iter_users(engine, plan, page_size):
+        if count == 0:
+            print("="*90)
+            print(f"{'Username':<20} {'API Key':<38} {'Plan':<11} {'Usage':<12} {'Tokens'}")
+            print("-"*90)
+        usage = f"{user['message_count']}/{user['message_limit']}"
+        tokens = f"{user['token_count']}/{user['token_limit']}"
+        print(f"{user['username']:<20} {user['api_key']:<38} {user['plan']:<11} {usage:<12} {tokens}")
+        count += 1
+    if not count:
         print("В базе данных пока нет пользователей.")
         return
+    print("="*90)
+    print(f"Всего: {count}")
+
+
+def detect_format(path, fmt):
+    if fmt:
+        return fmt
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+def read_rows(path, fmt):
+    with open(path, newline='', encoding='utf-8') as f:
+        if fmt == 'csv':
+            yield from csv.DictReader(f)
+        else:
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        raise SystemExit(f"❌ Строка {number}: некорректный JSON")
 
-    print("="*70)
-    print(f"{'Username':<20} {'API Key':<38} {'Usage':<12}")
-    print("-"*70)
-    for user in users:
-        usage = f"{user[2]}/{user[3]}"
-        print(f"{user[0]:<20} {user[1]:<38} {usage:<12}")
-    print("="*70)
-    
-    conn.close()
+def _import_row(row, default_plan):
+    username = (row.get('username') or '').strip()
+    if not username:
+        raise ValueError("username is required")
+    plan = row.get('plan') or default_plan
+    message_limit, token_limit = plan_limits(plan)
+    # Пустые значения в CSV - это "по тарифу"
+    value = lambda name, default: int(row[name]) if row.get(name) not in (None, '') else default
+    return {
+        "api_key": row.get('api_key') or new_api_key(),
+        "username": username,
+        "plan": plan,
+        "message_limit": value('message_limit', message_limit),
+        "token_limit": value('token_limit', token_limit),
+        "message_count": value('message_count', 0),
+        "token_count": value('token_count', 0),
+    }
+
+def import_users(engine, path, fmt=None, plan='free', on_conflict='skip', keys_out=None):
+    """Импорт из CSV/JSONL одной транзакцией: при любой ошибке в файле не добавится никто."""
+    fmt = detect_format(path, fmt)
+    statement = insert(users)
+    if on_conflict == 'update':
+        # Существующему пользователю (по username) обновляем тариф и лимиты, ключ и счетчики не трогаем
+        statement = statement.on_conflict_do_update(index_elements=[users.c.username], set_={
+            "plan": statement.excluded.plan,
+            "message_limit": statement.excluded.message_limit,
+            "token_limit": statement.excluded.token_limit,
+        })
+    else:
+        statement = statement.on_conflict_do_nothing()
+
+    total = 0
+    usernames = []
+    try:
+        with engine.begin() as conn:
+            for number, chunk in enumerate(chunks(read_rows(path, fmt))):
+                try:
+                    rows = [_import_row(row, plan) for row in chunk]
+                except (ValueError, TypeError) as e:
+                    raise SystemExit(f"❌ Ошибка в записи {number * CHUNK_SIZE + 1}-{number * CHUNK_SIZE + len(chunk)}: {e}")
+                conn.execute(statement, rows)
+                total += len(rows)
+                if keys_out:
+                    usernames.extend(row['username'] for row in rows)
+    except IntegrityError as e:
+        sys.exit(f"❌ Импорт отменен, ни один пользователь не добавлен: {e.orig}")
+    with engine.connect() as conn:
+        count = conn.execute(select(func.count()).select_from(users)).scalar()
+    print(f"✅ Обработано записей: {total}. Пользователей в базе: {count}.")
+    if keys_out:
+        # Ключи берем из базы: у пропущенных (уже существовавших) пользователей остается их старый ключ
+        with open(keys_out, 'w', newline='', encoding='utf-8') as f, engine.connect() as conn:
+            writer = csv.writer(f)
+            writer.writerow(('username', 'api_key'))
+            for chunk in chunks(usernames, 500):
+                writer.writerows(conn.execute(select(users.c.username, users.c.api_key)
+                                              .where(users.c.username.in_(chunk))))
+        print(f"   Ключи записаны в {keys_out}")
+
+
+def export_users(engine, path, fmt=None, plan=None):
+    fmt = detect_format(path, fmt)
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=EXPORT_COLUMNS) if fmt == 'csv' else None
+        if writer:
+            writer.writeheader()
+        for user in iter_users(engine, plan):
+            if writer:
+                writer.writerow(user)
+            else:
+                f.write(json.dumps(user, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"✅ Выгружено пользователей: {count} -> {path}")
+
+
+def _usernames(args):
+    names = list(args.users or [])
+    if args.users_file:
+        with open(args.users_file, encoding='utf-8') as f:
+            names.extend(line.strip() for line in f if line.strip())
+    return names
+
+def bulk_update(engine, args, values, description):
+    """UPDATE для выбранных пользователей: по списку имен (executemany), по тарифу или всем."""
+    names = _usernames(args)
+    if not names and not args.plan and not args.all:
+        sys.exit("❌ Укажите пользователей: --users, --users-file, --plan или --all")
+    statement = update(users).values(**values)
+    with engine.begin() as conn:
+        if names:
+            statement = statement.where(users.c.username == bindparam('target_username'))
+            changed = 0
+            for chunk in chunks(names):
+                changed += conn.execute(statement, [{"target_username": name} for name in chunk]).rowcount
+        else:
+            if args.plan:
+                statement = statement.where(users.c.plan == args.plan)
+            changed = conn.execute(statement).rowcount
+    print(f"✅ {description}: изменено пользователей - {changed}")
+
+def add_target_arguments(subparser):
+    subparser.add_argument('--users', nargs='+', help='Имена пользователей')
+    subparser.add_argument('--users-file', help='Файл с именами пользователей, по одному в строке')
+    subparser.add_argument('--plan', help='Все пользователи с этим (текущим) тарифом')
+    subparser.add_argument('--all', action='store_true', help='Все пользователи')
 
 
 if __name__ == '__main__':
-    # Создаем базу, если ее нет
-    setup_database()
-    
     parser = argparse.ArgumentParser(description="Утилита для управления пользователями.")
     subparsers = parser.add_subparsers(dest='command', required=True)
-    
+
     # Команда 'add'
     parser_add = subparsers.add_parser('add', help='Добавить нового пользователя')
     parser_add.add_argument('username', type=str, help='Имя пользователя')
-    parser_add.add_argument('--limit', type=int, default=100, help='Лимит сообщений (по умолчанию: 100)')
-    
+    parser_add.add_argument('--limit', type=int, help='Лимит сообщений (по умолчанию - по тарифу)')
+    parser_add.add_argument('--plan', default='free', help='Тариф (по умолчанию: free)')
+
     # Команда 'list'
-    parser_list = subparsers.add_parser('list', help='Показать список всех пользователей')
-    
+    parser_list = subparsers.add_parser('list', help='Показать список пользователей')
+    parser_list.add_argument('--plan', help='Только пользователи этого тарифа')
+    parser_list.add_argument('--page-size', type=int, default=CHUNK_SIZE, help='Строк на одну выборку из БД')
+
+    parser_import = subparsers.add_parser('import', help='Массово добавить пользователей из CSV/JSONL')
+    parser_import.add_argument('path', help='Файл с колонками username[, api_key, plan, message_limit, token_limit, ...]')
+    parser_import.add_argument('--format', choices=('csv', 'jsonl'), help='По умолчанию - по расширению файла')
+    parser_import.add_argument('--plan', default='free', help='Тариф для строк без колонки plan')
+    parser_import.add_argument('--on-conflict', choices=('skip', 'update'), default='skip',
+                               help='Что делать с уже существующим username')
+    parser_import.add_argument('--keys-out', help='Записать username,api_key в CSV-файл')
+
+    parser_export = subparsers.add_parser('export', help='Выгрузить пользователей в CSV/JSONL')
+    parser_export.add_argument('path')
+    parser_export.add_argument('--format', choices=('csv', 'jsonl'), help='По умолчанию - по расширению файла')
+    parser_export.add_argument('--plan', help='Только пользователи этого тарифа')
+
+    parser_set_plan = subparsers.add_parser('set-plan', help='Сменить тариф (и лимиты по нему)')
+    parser_set_plan.add_argument('new_plan', help='Новый тариф')
+    add_target_arguments(parser_set_plan)
+
+    parser_set_limit = subparsers.add_parser('set-limit', help='Задать лимиты сообщений и/или токенов')
+    parser_set_limit.add_argument('--messages', type=int, help='Новый лимит сообщений')
+    parser_set_limit.add_argument('--tokens', type=int, help='Новый лимит токенов')
+    add_target_arguments(parser_set_limit)
+
+    parser_reset = subparsers.add_parser('reset-counters', help='Обнулить счетчики сообщений и токенов')
+    add_target_arguments(parser_reset)
+
     args = parser.parse_args()
-    
+
+    # Создаем базу, если ее нет
+    engine = get_engine()
+    setup_database(engine)
+
     if args.command == 'add':
-        add_user(args.username, args.limit)
+        add_user(engine, args.username, args.limit, args.plan)
     elif args.command == 'list':
-        list_users()
\ No newline at end of file
+        list_users(engine, args.plan, args.page_size)
+    elif args.command == 'import':
+        plan_limits(args.plan)
+        import_users(engine, args.path, args.format, args.plan, args.on_conflict, args.keys_out)
+    elif args.command == 'export':
+        export_users(engine, args.path, args.format, args.plan)
+    elif args.command == 'set-plan':
+        message_limit, token_limit = plan_limits(args.new_plan)
+        bulk_update(engine, args, {"plan": args.new_plan, "message_limit": message_limit, "token_limit": token_limit},
+                    f"Тариф {args.new_plan}")
+    elif args.command == 'set-limit':
+        values = {}
+        if args.messages is not None:
+            values["message_limit"] = args.messages
+        if args.tokens is not None:
+            values["token_limit"] = args.tokens
+        if not values:
+            sys.exit("❌ Укажите --messages и/или --tokens")
+        bulk_update(engine, args, values, "Лимиты")
+    elif args.command == 'reset-counters':
+        bulk_update(engine, args, {"message_count": 0, "token_count": 0}, "Счетчики обнулены")
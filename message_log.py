@@ -0,0 +1,94 @@
+# message_log.py
+# Фоновая запись лога сообщений (таблица messages).
+# Запрос только кладет строки в ограниченную очередь, а отдельный поток
+# забирает их пачками и вставляет одной транзакцией (executemany).
+import atexit
+import queue
+import threading
+
+
+class MessageLogWriter:
+    def __init__(self, insert_fn, maxsize=10000, batch_size=500, interval=1.0,
+                 policy='drop', block_timeout=0.05):
+        # insert_fn(rows) - вставляет список словарей в messages одной транзакцией
+        # policy - что делать при переполненной очереди:
+        #   'drop'  - сразу выбросить запись (запрос пользователя не ждет);
+        #   'block' - подождать block_timeout секунд освобождения места, потом выбросить
+        self.insert_fn = insert_fn
+        self.batch_size = batch_size
+        self.interval = interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+
+    def enqueue(self, row):
+        self._ensure_started()
+        try:
+            if self.policy == 'block':
+                self._queue.put(row, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def _ensure_started(self):
+        if self._thread is not None or self._stopped:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _take_batch(self, timeout):
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        try:
+            self.insert_fn(batch)
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"ОШИБКА: Не удалось записать лог сообщений ({len(batch)} шт.): {e}")
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def _run(self):
+        while not self._stopped:
+            batch = self._take_batch(self.interval)
+            if batch:
+                self._write(batch)
+
+    def flush(self):
+        """Синхронно записывает все, что накопилось в очереди."""
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            self._write(batch)
+
+    def stop(self):
+        self._stopped = True
+        self.flush()
+
+    def stats(self):
+        return {"queued": self._queue.qsize(), "written": self.written, "dropped": self.dropped,
+                "failed": self.failed, "batches": self.batches}
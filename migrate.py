@@ -1,29 +1,46 @@
 # migrate.py
-import sqlite3
-
-DB_NAME = 'users.db'
-
-print("Запуск миграции базы данных...")
-
-try:
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    # Проверяем, существует ли уже колонка 'plan'
-    cursor.execute("PRAGMA table_info(users)")
-    columns = [info[1] for info in cursor.fetchall()]
-
-    if 'plan' not in columns:
-        print("Колонка 'plan' не найдена. Добавляем...")
-        # Добавляем новую колонку 'plan' с тарифом 'free' по умолчанию для всех
-        cursor.execute("ALTER TABLE users ADD COLUMN plan TEXT NOT NULL DEFAULT 'free'")
-        conn.commit()
-        print("✅ Колонка 'plan' успешно добавлена. Все существующие пользователи получили тариф 'free'.")
-    else:
-        print("✅ Колонка 'plan' уже существует. Миграция не требуется.")
-
-except Exception as e:
-    print(f"❌ Произошла ошибка: {e}")
-finally:
-    if conn:
-        conn.close()
\ No newline at end of file
+# Обновляет схему базы до последней версии (сами миграции - в migrations.py).
+# Можно запускать на работающем сервере: DDL выполняется короткими транзакциями,
+# данные заполняются пачками.
+#   python migrate.py            - применить недостающие миграции
+#   python migrate.py status     - показать версию схемы и ожидающие миграции
+#   python migrate.py --batch-size 200
+import os
+import sys
+import argparse
+
+import migrations
+
+DB_NAME = os.environ.get('DATABASE_PATH', 'users.db')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Миграции схемы базы данных")
+    parser.add_argument('command', nargs='?', choices=('upgrade', 'status'), default='upgrade')
+    parser.add_argument('--batch-size', type=int, default=migrations.BACKFILL_BATCH_SIZE,
+                        help="строк в одной транзакции при заполнении данных")
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        conn = migrations.connect(DB_NAME)
+        try:
+            print(f"Версия схемы: {migrations.current_version(conn)} (последняя: {migrations.LATEST_VERSION})")
+            for version, name, _ in migrations.pending(conn):
+                print(f"  ожидает: {version} - {name}")
+        finally:
+            conn.close()
+        return 0
+
+    print("Запуск миграции базы данных...")
+    try:
+        applied = migrations.migrate(DB_NAME, batch_size=args.batch_size)
+    except Exception as e:
+        print(f"❌ Произошла ошибка: {e}")
+        return 1
+    if not applied:
+        print("✅ Схема уже актуальна. Миграция не требуется.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
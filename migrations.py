@@ -0,0 +1,240 @@
+# migrations.py
+# Версионированные миграции схемы SQLite. Примененные версии записываются в schema_migrations.
+# Каждая миграция идемпотентна (проверяет, есть ли уже колонка/индекс), поэтому ее можно
+# повторить на базе, которую раньше обновляли вручную старым migrate.py.
+# Миграции рассчитаны на работающую базу: DDL - короткими транзакциями, а заполнение
+# новых колонок (backfill) - пачками по rowid, каждая пачка в своей транзакции.
+import time
+import sqlite3
+from datetime import datetime, timezone
+
+BACKFILL_BATCH_SIZE = 500
+# Пауза между пачками, чтобы запросы сервера успевали взять блокировку записи
+BACKFILL_PAUSE = 0.01
+BUSY_TIMEOUT_MS = 30000
+
+
+def connect(path):
+    # isolation_level=None - транзакциями управляем сами (BEGIN IMMEDIATE ... COMMIT)
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    return conn
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def has_index_on(conn, table, column):
+    for index in conn.execute(f"PRAGMA index_list({table})").fetchall():
+        index_columns = [info[2] for info in conn.execute(f"PRAGMA index_info('{index[1]}')").fetchall()]
+        if index_columns[:1] == [column]:
+            return True
+    return False
+
+def add_column(conn, table, column, definition):
+    if column not in columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def backfill(conn, table, set_clause, where='1', params=None, batch_size=None):
+    """UPDATE всей таблицы окнами по rowid: каждая пачка - отдельная короткая транзакция,
+    между пачками база свободна для сервера. Возвращает число обновленных строк."""
+    batch_size = batch_size or BACKFILL_BATCH_SIZE
+    max_rowid = conn.execute(f"SELECT MAX(rowid) FROM {table}").fetchone()[0] or 0
+    updated = 0
+    for start in range(0, max_rowid, batch_size):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(f"UPDATE {table} SET {set_clause} WHERE rowid > :start AND rowid <= :end AND ({where})",
+                                  dict(params or {}, start=start, end=start + batch_size))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        updated += cursor.rowcount
+        time.sleep(BACKFILL_PAUSE)
+    return updated
+
+
+# --- МИГРАЦИИ ---
+# Каждая функция получает соединение внутри открытой транзакции (BEGIN IMMEDIATE).
+# Для долгого заполнения данных миграция возвращает функцию fill(conn, batch_size), она выполняется
+# после фиксации DDL, пачками вне общей транзакции.
+
+def _create_users(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            api_key TEXT PRIMARY KEY,
+            username TEXT NOT NULL UNIQUE,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            message_limit INTEGER NOT NULL
+        )
+    ''')
+
+def _add_plan(conn):
+    # Все существующие пользователи получают тариф 'free'
+    add_column(conn, 'users', 'plan', "TEXT NOT NULL DEFAULT 'free'")
+
+def _create_messages(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            user_api_key TEXT NOT NULL REFERENCES users (api_key),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp DATETIME DEFAULT (CURRENT_TIMESTAMP)
+        )
+    ''')
+    # История конкретного пользователя выбирается по (user_api_key, timestamp)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_messages_user_api_key_timestamp ON messages (user_api_key, timestamp)")
+
+def _index_username(conn):
+    # Поиск по username (create_internal_user, вход) должен идти по индексу.
+    # Обычно его дает UNIQUE из схемы, но в старых базах ограничения может не быть.
+    if not has_index_on(conn, 'users', 'username'):
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_users_username ON users (username)")
+
+def _add_token_accounting(conn):
+    add_column(conn, 'users', 'token_count', "INTEGER NOT NULL DEFAULT 0")
+    add_column(conn, 'users', 'token_limit', "INTEGER NOT NULL DEFAULT 100000")
+
+    def fill_token_limits(conn, batch_size):
+        # Значения те же, что в TARIFF_PLANS; пользователей free трогать не нужно - у них уже DEFAULT
+        return backfill(conn, 'users', """token_limit = CASE plan
+                WHEN 'pro' THEN 2000000
+                WHEN 'enterprise' THEN 10000000
+                ELSE token_limit
+            END""", where="plan IN ('pro', 'enterprise') AND token_limit = 100000", batch_size=batch_size)
+    return fill_token_limits
+
+def _create_batches(conn):
+    # Пакетная обработка: загруженные файлы, пакеты и по строке на каждый запрос пакета
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS batch_files (
+            id TEXT NOT NULL PRIMARY KEY,
+            user_api_key TEXT NOT NULL REFERENCES users (api_key),
+            purpose TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            bytes INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at INTEGER NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_batch_files_user_api_key ON batch_files (user_api_key)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT NOT NULL PRIMARY KEY,
+            user_api_key TEXT NOT NULL REFERENCES users (api_key),
+            endpoint TEXT NOT NULL,
+            input_file_id TEXT NOT NULL,
+            completion_window TEXT NOT NULL,
+            status TEXT NOT NULL,
+            output_file_id TEXT,
+            error_file_id TEXT,
+            metadata_json TEXT,
+            created_at INTEGER NOT NULL,
+            finalizing_at INTEGER,
+            completed_at INTEGER,
+            cancelled_at INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_batches_user_api_key ON batches (user_api_key)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS batch_requests (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL REFERENCES batches (id),
+            line INTEGER NOT NULL,
+            custom_id TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            not_before FLOAT NOT NULL,
+            claimed_by TEXT,
+            claimed_at FLOAT,
+            status_code INTEGER,
+            response TEXT
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_batch_requests_batch_id_status ON batch_requests (batch_id, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_batch_requests_status_not_before ON batch_requests (status, not_before)")
+
+
+# Порядок и номера версий менять нельзя - только добавлять новые в конец
+MIGRATIONS = [
+    (1, 'users table', _create_users),
+    (2, 'users.plan column', _add_plan),
+    (3, 'messages table and (user_api_key, timestamp) index', _create_messages),
+    (4, 'users.username index', _index_username),
+    (5, 'token accounting columns', _add_token_accounting),
+    (6, 'batch tables', _create_batches),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER NOT NULL PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+
+def current_version(conn):
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_migrations'").fetchone()
+    if not exists:
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations").fetchone()[0]
+
+def pending(conn):
+    version = current_version(conn)
+    return [migration for migration in MIGRATIONS if migration[0] > version]
+
+def migrate(path, log=print, batch_size=None):
+    """Применяет недостающие миграции по порядку. Безопасно запускать одновременно из нескольких
+    процессов: версия перепроверяется под блокировкой записи. Возвращает число примененных миграций."""
+    conn = connect(path)
+    applied = 0
+    try:
+        _ensure_version_table(conn)
+        for version, name, apply in MIGRATIONS:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if current_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                started = time.monotonic()
+                fill = apply(conn)
+                if fill is None:
+                    _record(conn, version, name)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            if fill is not None:
+                # Версию записываем только после заполнения: если процесс прервется, миграция повторится
+                rows = fill(conn, batch_size)
+                conn.execute("BEGIN IMMEDIATE")
+                if current_version(conn) < version:
+                    _record(conn, version, name)
+                conn.execute("COMMIT")
+                log(f"✅ Миграция {version}: {name} (заполнено строк: {rows}, {time.monotonic() - started:.2f} с)")
+            else:
+                log(f"✅ Миграция {version}: {name} ({time.monotonic() - started:.2f} с)")
+            applied += 1
+        # WAL сохраняется в самом файле базы, достаточно включить один раз
+        journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        log(f"✅ Схема версии {current_version(conn)}, режим журнала SQLite: {journal_mode}")
+    finally:
+        conn.close()
+    return applied
+
+def _record(conn, version, name):
+    conn.execute("INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)",
+                 (version, name, datetime.now(timezone.utc).isoformat(timespec='seconds')))
+
+def verify(path):
+    """(текущая версия, последняя версия) - для проверки при запуске сервера."""
+    conn = connect(path)
+    try:
+        return current_version(conn), LATEST_VERSION
+    finally:
+        conn.close()
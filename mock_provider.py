@@ -0,0 +1,126 @@
+# mock_provider.py
+# Локальная заглушка провайдера для нагрузочного тестирования.
+# Понимает OpenAI-совместимый /v1/chat/completions и Gemini generateContent / streamGenerateContent,
+# с настраиваемыми задержкой, скоростью генерации токенов, долей ошибок и потоковой выдачей.
+#
+# Запуск отдельно: python mock_provider.py --port 8799 --latency 0.5 --tokens 50 --token-rate 200
+import json
+import time
+import logging
+import random
+import argparse
+import threading
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+
+class MockConfig:
+    def __init__(self, latency=0.2, tokens=50, token_rate=200.0, error_rate=0.0, error_status=500):
+        self.latency = latency          # задержка до первого токена, секунды
+        self.tokens = tokens            # сколько "токенов" в ответе
+        self.token_rate = token_rate    # токенов в секунду; 0 - весь ответ сразу
+        self.error_rate = error_rate    # доля запросов, которые завершаются ошибкой
+        self.error_status = error_status
+
+    def generation_time(self):
+        return self.tokens / self.token_rate if self.token_rate else 0.0
+
+
+def create_app(config):
+    app = Flask('mock_provider')
+    stats = {"requests": 0, "errors": 0}
+    stats_lock = threading.Lock()
+    app.config['MOCK_STATS'] = stats
+
+    def _count(error=False):
+        with stats_lock:
+            stats["requests"] += 1
+            if error:
+                stats["errors"] += 1
+
+    def _maybe_fail():
+        if config.error_rate and random.random() < config.error_rate:
+            _count(error=True)
+            return jsonify({"error": {"message": "mock provider error"}}), config.error_status
+        _count()
+        return None
+
+    def _words():
+        return [f"tok{i} " for i in range(config.tokens)]
+
+    def _stream(events, done_marker=False):
+        def generate():
+            time.sleep(config.latency)
+            for event in events:
+                if config.token_rate:
+                    time.sleep(1 / config.token_rate)
+                yield f"data: {json.dumps(event)}\n\n"
+            if done_marker:
+                # OpenAI завершает поток строкой [DONE], Gemini - просто закрывает соединение
+                yield "data: [DONE]\n\n"
+        return Response(generate(), mimetype='text/event-stream')
+
+    @app.route('/v1/chat/completions', methods=['POST'])
+    def openai_chat():
+        error = _maybe_fail()
+        if error:
+            return error
+        body = request.json or {}
+        prompt_tokens = sum(len(str(msg.get('content', '')).split()) for msg in body.get('messages', []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": config.tokens,
+                 "total_tokens": prompt_tokens + config.tokens}
+        if body.get('stream'):
+            events = [{"object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {"content": word}}]} for word in _words()]
+            if (body.get('stream_options') or {}).get('include_usage'):
+                events.append({"object": "chat.completion.chunk", "choices": [], "usage": usage})
+            return _stream(events, done_marker=True)
+        time.sleep(config.latency + config.generation_time())
+        return jsonify({"object": "chat.completion", "model": body.get('model'),
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(_words())},
+                                     "finish_reason": "stop"}],
+                        "usage": usage})
+
+    @app.route('/v1beta/models/<path:model_action>', methods=['POST'])
+    def gemini(model_action):
+        error = _maybe_fail()
+        if error:
+            return error
+        usage = {"promptTokenCount": 1, "candidatesTokenCount": config.tokens, "totalTokenCount": config.tokens + 1}
+        if model_action.endswith(':streamGenerateContent'):
+            return _stream([{"candidates": [{"content": {"parts": [{"text": word}]}}], "usageMetadata": usage}
+                            for word in _words()])
+        time.sleep(config.latency + config.generation_time())
+        return jsonify({"candidates": [{"content": {"parts": [{"text": "".join(_words())}]}}],
+                        "usageMetadata": usage})
+
+    @app.route('/stats')
+    def mock_stats():
+        return jsonify(stats)
+
+    return app
+
+
+def start_in_thread(config, host='127.0.0.1', port=0):
+    """Запускает заглушку в фоновом потоке. Возвращает (server, base_url)."""
+    # Внутри нагрузочного теста журнал запросов werkzeug только мешает
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server(host, port, create_app(config), threaded=True)
+    threading.Thread(target=server.serve_forever, name='mock-provider', daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Заглушка провайдера LLM для нагрузочных тестов.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8799)
+    parser.add_argument('--latency', type=float, default=0.2, help='Задержка до первого токена, с (по умолчанию: 0.2)')
+    parser.add_argument('--tokens', type=int, default=50, help='Токенов в ответе (по умолчанию: 50)')
+    parser.add_argument('--token-rate', type=float, default=200, help='Токенов в секунду, 0 - мгновенно (по умолчанию: 200)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Доля ответов с ошибкой (по умолчанию: 0)')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP-код ошибки (по умолчанию: 500)')
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency, args.tokens, args.token_rate, args.error_rate, args.error_status)
+    print(f"Заглушка провайдера слушает http://{args.host}:{args.port}")
+    make_server(args.host, args.port, create_app(config), threaded=True).serve_forever()
@@ -0,0 +1,113 @@
+# model_config.py
+# Алиасы моделей (MODEL_MAPPING): из JSON-файла MODEL_CONFIG или, если файл не задан,
+# встроенный набор по ключам провайдеров из окружения. Файл перечитывается при изменении
+# (проверяется mtime не чаще раза в MODEL_CONFIG_CHECK_INTERVAL секунд), перезапуск не нужен.
+# Формат файла - как у DEFAULT_MODELS, пример: model_config.example.json.
+import os
+import json
+import time
+import threading
+
+# Встроенные алиасы. Бэкенд с api_key_env размножается по ключам из этой переменной
+# (несколько ключей через запятую: OPENAI_API_KEY=sk-1,sk-2), {api_key} в provider_url
+# заменяется ключом. Алиас, для которого не нашлось ни одного ключа, не публикуется.
+DEFAULT_MODELS = {
+    "klassicheskiy-gpt4": {"backends": [
+        {"provider": "openai", "real_model": "gpt-3.5-turbo",
+         "provider_url": "https://api.openai.com/v1/chat/completions", "api_key_env": "OPENAI_API_KEY"}]},
+    "tvoy-bystriy-gemini": {"backends": [
+        {"provider": "google", "real_model": "gemini-2.0-flash",
+         "provider_url": "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={api_key}",
+         "api_key_env": "GOOGLE_API_KEY"}]},
+    "besplatniy-compound": {"backends": [
+        {"provider": "openai", "real_model": "groq/compound-mini",
+         "provider_url": "https://api.groq.com/openai/v1/chat/completions", "api_key_env": "GROQ_API_KEY"}]},
+}
+
+_REQUIRED_FIELDS = ('provider', 'real_model', 'provider_url')
+
+
+def split_keys(value):
+    return [key.strip() for key in (value or '').split(',') if key.strip()]
+
+
+def expand(config, default_routing='weighted', env=None):
+    """Конфигурация (формат DEFAULT_MODELS) -> MODEL_MAPPING с отдельным бэкендом на каждый ключ.
+    При ошибке в конфигурации бросает ValueError с именем алиаса."""
+    env = os.environ if env is None else env
+    if not isinstance(config, dict):
+        raise ValueError("expected a JSON object {alias: {...}}")
+    mapping = {}
+    for alias, details in config.items():
+        if not isinstance(details, dict) or not isinstance(details.get('backends'), list):
+            raise ValueError(f"{alias}: 'backends' must be a list")
+        backends = []
+        for backend in details['backends']:
+            missing = [field for field in _REQUIRED_FIELDS if not isinstance(backend, dict) or not backend.get(field)]
+            if missing:
+                raise ValueError(f"{alias}: backend without {', '.join(missing)}")
+            keys = split_keys(env.get(backend['api_key_env'])) if backend.get('api_key_env') else [backend.get('api_key')]
+            for key in keys:
+                entry = {name: value for name, value in backend.items() if name != 'api_key_env'}
+                entry['api_key'] = key
+                entry['provider_url'] = backend['provider_url'].replace('{api_key}', key or '')
+                backends.append(entry)
+        if backends:
+            mapping[alias] = dict(details, routing=details.get('routing', default_routing), backends=backends)
+    return mapping
+
+
+class ModelMapping:
+    def __init__(self, path=None, default_routing='weighted', check_interval=2.0, on_change=None):
+        # on_change(mapping) вызывается после каждой успешной перезагрузки файла
+        self.path = path
+        self.default_routing = default_routing
+        self.check_interval = check_interval
+        self.on_change = on_change
+        self.reloads = 0
+        self._mtime = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+        self._mapping = {}
+        if not path:
+            self._mapping = expand(DEFAULT_MODELS, default_routing)
+        elif not self._reload():
+            print(f"ОШИБКА: Не удалось загрузить {path}, используются встроенные модели по ключам из окружения")
+            self._mapping = expand(DEFAULT_MODELS, default_routing)
+
+    def current(self):
+        """Актуальный MODEL_MAPPING. Словарь не изменяется на месте - при перезагрузке подменяется целиком."""
+        if self.path and time.monotonic() >= self._next_check:
+            # Файл проверяет один поток, остальные не ждут и берут текущую версию
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._next_check = time.monotonic() + self.check_interval
+                    self._reload()
+                finally:
+                    self._lock.release()
+        return self._mapping
+
+    def _reload(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            if self._mtime is not None:
+                print(f"ОШИБКА: Файл моделей {self.path} недоступен ({e}), остаются прежние модели")
+                self._mtime = None
+            return False
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        if mtime == self._mtime:
+            return True
+        self._mtime = mtime
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                mapping = expand(json.load(f), self.default_routing)
+        except (OSError, ValueError) as e:
+            print(f"ОШИБКА: Файл моделей {self.path} не загружен ({e}), остаются прежние модели")
+            return False
+        self._mapping = mapping
+        self.reloads += 1
+        print(f"✅ Модели загружены из {self.path}: {', '.join(mapping) or 'нет ни одной'}")
+        if self.on_change:
+            self.on_change(mapping)
+        return True
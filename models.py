@@ -0,0 +1,85 @@
+# models.py
+# Схема базы данных и тарифы. Общие для сервера (custom_provider.py) и консольных утилит
+# (manage_users.py): утилиты используют те же таблицы, не поднимая Flask-приложение.
+from flask_sqlalchemy import SQLAlchemy
+
+# --- ТАРИФНЫЕ ПЛАНЫ ---
+# Управляем всеми тарифами из одного места
+# limit - сообщений, token_limit - токенов (вопрос + ответ) на весь тариф
+# rpm / tpm / concurrency - запросов в минуту, токенов в минуту и одновременных запросов на один ключ (0 - без ограничения)
+TARIFF_PLANS = {
+    'free': {'limit': 100, 'token_limit': 100_000, 'rpm': 20, 'tpm': 40_000, 'concurrency': 2,
+             'price': 0, 'stripe_price_id': 'YOUR_FREE_PLAN_ID'},
+    'pro': {'limit': 1000, 'token_limit': 2_000_000, 'rpm': 60, 'tpm': 200_000, 'concurrency': 8,
+            'price': 10, 'stripe_price_id': 'price_1SSI67RPenat6xXbIaMWAGdc'},
+    'enterprise': {'limit': 5000, 'token_limit': 10_000_000, 'rpm': 300, 'tpm': 1_000_000, 'concurrency': 32,
+                   'price': 40, 'stripe_price_id': 'price_1SSI6fRPenat6xXbv14IqeUD'}
+}
+
+db = SQLAlchemy()
+
+# --- МОДЕЛИ (обновлена модель User) ---
+class User(db.Model):
+    __tablename__ = 'users'
+    api_key = db.Column(db.Text, primary_key=True)
+    username = db.Column(db.Text, unique=True, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    message_limit = db.Column(db.Integer, nullable=False)
+    plan = db.Column(db.Text, nullable=False, default='free') # <-- НОВОЕ ПОЛЕ
+    token_count = db.Column(db.Integer, nullable=False, default=0)
+    token_limit = db.Column(db.Integer, nullable=False, default=TARIFF_PLANS['free']['token_limit'])
+
+class Message(db.Model):
+    __tablename__ = 'messages'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_api_key = db.Column(db.Text, db.ForeignKey('users.api_key'), nullable=False)
+    role = db.Column(db.Text, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, server_default=db.func.now())
+    # История конкретного пользователя выбирается по (user_api_key, timestamp)
+    __table_args__ = (db.Index('ix_messages_user_api_key_timestamp', 'user_api_key', 'timestamp'),)
+
+# --- ПАКЕТЫ (/v1/files, /v1/batches) ---
+class BatchFile(db.Model):
+    __tablename__ = 'batch_files'
+    id = db.Column(db.Text, primary_key=True)
+    user_api_key = db.Column(db.Text, db.ForeignKey('users.api_key'), nullable=False, index=True)
+    purpose = db.Column(db.Text, nullable=False)
+    filename = db.Column(db.Text, nullable=False)
+    bytes = db.Column(db.Integer, nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.Integer, nullable=False)
+
+class Batch(db.Model):
+    __tablename__ = 'batches'
+    id = db.Column(db.Text, primary_key=True)
+    user_api_key = db.Column(db.Text, db.ForeignKey('users.api_key'), nullable=False, index=True)
+    endpoint = db.Column(db.Text, nullable=False)
+    input_file_id = db.Column(db.Text, nullable=False)
+    completion_window = db.Column(db.Text, nullable=False, default='24h')
+    status = db.Column(db.Text, nullable=False)  # in_progress -> completed, или cancelling -> cancelled
+    output_file_id = db.Column(db.Text)
+    error_file_id = db.Column(db.Text)
+    metadata_json = db.Column(db.Text)
+    created_at = db.Column(db.Integer, nullable=False)
+    finalizing_at = db.Column(db.Integer)
+    completed_at = db.Column(db.Integer)
+    cancelled_at = db.Column(db.Integer)
+
+class BatchRequest(db.Model):
+    # Результат каждого запроса сохраняется сразу, поэтому после перезапуска пакет продолжается с места остановки
+    __tablename__ = 'batch_requests'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    batch_id = db.Column(db.Text, db.ForeignKey('batches.id'), nullable=False)
+    line = db.Column(db.Integer, nullable=False)
+    custom_id = db.Column(db.Text, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Text, nullable=False, default='pending')  # pending, running, done, failed, cancelled
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    not_before = db.Column(db.Float, nullable=False, default=0)
+    claimed_by = db.Column(db.Text)
+    claimed_at = db.Column(db.Float)
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.Text)
+    __table_args__ = (db.Index('ix_batch_requests_batch_id_status', 'batch_id', 'status'),
+                      db.Index('ix_batch_requests_status_not_before', 'status', 'not_before'))
@@ -0,0 +1,219 @@
+# ratelimit.py
+# Ограничение частоты запросов по API-ключу: запросы в минуту (rpm), токены в минуту (tpm)
+# и число одновременных запросов (concurrency). Размер ведер задается тарифом пользователя.
+# Бэкенды: в памяти процесса или в отдельном файле SQLite (общий для всех воркеров gunicorn).
+import os
+import math
+import time
+import uuid
+import sqlite3
+import threading
+
+
+class RateLimits:
+    """Лимиты одного ключа. 0 - без ограничения."""
+    __slots__ = ('rpm', 'tpm', 'concurrency')
+
+    def __init__(self, rpm=0, tpm=0, concurrency=0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.concurrency = concurrency
+
+    @classmethod
+    def from_plan(cls, plan):
+        return cls(plan.get('rpm', 0), plan.get('tpm', 0), plan.get('concurrency', 0))
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"rate limited: {reason}, retry after {retry_after:.1f}s")
+        self.reason = reason  # 'rpm', 'tpm' или 'concurrency'
+        self.retry_after = retry_after
+
+
+def _refill(level, updated, now, per_minute):
+    # Ведро вмещает минутный лимит и пополняется равномерно, per_minute / 60 в секунду
+    return min(per_minute, level + (now - updated) * per_minute / 60.0)
+
+
+def take(rpm_level, tpm_level, updated, now, limits, tokens):
+    """Пытается взять из ведер один запрос и tokens токенов.
+    Возвращает новые уровни (rpm, tpm) или бросает RateLimited со временем ожидания."""
+    if limits.rpm:
+        rpm_level = _refill(rpm_level, updated, now, limits.rpm)
+        if rpm_level < 1:
+            raise RateLimited('rpm', (1 - rpm_level) * 60.0 / limits.rpm)
+    if limits.tpm:
+        tpm_level = _refill(tpm_level, updated, now, limits.tpm)
+        # Запрос больше минутного лимита пропускаем только при полном ведре, иначе он не пройдет никогда
+        cost = min(tokens, limits.tpm)
+        if tpm_level < cost:
+            raise RateLimited('tpm', (cost - tpm_level) * 60.0 / limits.tpm)
+        tpm_level -= tokens
+    if limits.rpm:
+        rpm_level -= 1
+    return rpm_level, tpm_level
+
+
+class MemoryRateLimiter:
+    # Сколько секунд ждать перед повтором, если заняты все одновременные слоты
+    CONCURRENCY_RETRY_AFTER = 1.0
+
+    def __init__(self):
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = {}  # api_key -> [rpm, tpm, updated, in_flight]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, limits, tokens=0):
+        """Проверяет все лимиты ключа и занимает слот. Возвращает слот для release()
+        или бросает RateLimited."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                # Ведра создаются полными; без лимита (0) - бесконечными, _refill обрежет их до лимита
+                bucket = self._buckets[key] = [limits.rpm or math.inf, limits.tpm or math.inf, now, 0]
+            if limits.concurrency and bucket[3] >= limits.concurrency:
+                self.limited += 1
+                raise RateLimited('concurrency', self.CONCURRENCY_RETRY_AFTER)
+            # Только слот (rpm и tpm равны 0) - ведра не трогаем, иначе сдвинется время их пополнения
+            if limits.rpm or limits.tpm:
+                try:
+                    bucket[0], bucket[1] = take(bucket[0], bucket[1], bucket[2], now, limits, tokens)
+                except RateLimited:
+                    self.limited += 1
+                    raise
+                bucket[2] = now
+            self.allowed += 1
+            if not limits.concurrency:
+                # Как и в SQLiteRateLimiter: без ограничения одновременных запросов слот не занимается
+                return None
+            bucket[3] += 1
+        return key
+
+    def release(self, slot):
+        with self._lock:
+            bucket = self._buckets.get(slot)
+            if bucket is not None and bucket[3] > 0:
+                bucket[3] -= 1
+
+    def settle(self, key, limits, delta_tokens):
+        """Поправка tpm, когда стал известен фактический расход. Ведро может уйти в минус:
+        тогда следующие запросы подождут, пока долг не восполнится."""
+        if not limits.tpm or not delta_tokens:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[1] = min(limits.tpm, bucket[1] - delta_tokens)
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(bucket[3] for bucket in self._buckets.values())
+            return {"backend": "memory", "keys": len(self._buckets), "in_flight": in_flight,
+                    "allowed": self.allowed, "limited": self.limited}
+
+
+class SQLiteRateLimiter:
+    CONCURRENCY_RETRY_AFTER = 1.0
+
+    def __init__(self, path, slot_ttl=600):
+        # slot_ttl - через сколько секунд слот считается брошенным (воркер упал, не вызвав release)
+        self.path = path
+        self.slot_ttl = slot_ttl
+        self.allowed = 0
+        self.limited = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key TEXT PRIMARY KEY,
+                rpm REAL NOT NULL,
+                tpm REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_slots (
+                id TEXT PRIMARY KEY,
+                key TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_rate_slots_key ON rate_slots (key, expires_at)")
+
+    def _conn(self):
+        # Отдельное соединение на поток: sqlite3.Connection нельзя делить между потоками.
+        # isolation_level=None - транзакциями управляем сами (BEGIN IMMEDIATE)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, key, limits, tokens=0):
+        # Время общее для всех воркеров, поэтому time.time(), а не monotonic
+        now = time.time()
+        conn = self._conn()
+        # BEGIN IMMEDIATE сразу берет блокировку записи: проверка и списание атомарны между воркерами
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if limits.concurrency:
+                in_flight = conn.execute("SELECT COUNT(*) FROM rate_slots WHERE key = ? AND expires_at > ?",
+                                         (key, now)).fetchone()[0]
+                if in_flight >= limits.concurrency:
+                    raise RateLimited('concurrency', self.CONCURRENCY_RETRY_AFTER)
+            if limits.rpm or limits.tpm:
+                row = conn.execute("SELECT rpm, tpm, updated_at FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+                rpm_level, tpm_level, updated = row if row is not None else (limits.rpm, limits.tpm, now)
+                rpm_level, tpm_level = take(rpm_level, tpm_level, updated, now, limits, tokens)
+                conn.execute("INSERT OR REPLACE INTO rate_buckets (key, rpm, tpm, updated_at) VALUES (?, ?, ?, ?)",
+                             (key, rpm_level, tpm_level, now))
+            slot = None
+            if limits.concurrency:
+                slot = uuid.uuid4().hex
+                conn.execute("DELETE FROM rate_slots WHERE key = ? AND expires_at <= ?", (key, now))
+                conn.execute("INSERT INTO rate_slots (id, key, expires_at) VALUES (?, ?, ?)",
+                             (slot, key, now + self.slot_ttl))
+            conn.execute("COMMIT")
+        except RateLimited:
+            conn.execute("ROLLBACK")
+            self.limited += 1
+            raise
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.allowed += 1
+        return slot
+
+    def release(self, slot):
+        if slot is not None:
+            self._conn().execute("DELETE FROM rate_slots WHERE id = ?", (slot,))
+
+    def settle(self, key, limits, delta_tokens):
+        if not limits.tpm or not delta_tokens:
+            return
+        self._conn().execute("UPDATE rate_buckets SET tpm = MIN(?, tpm - ?) WHERE key = ?",
+                             (limits.tpm, delta_tokens, key))
+
+    def stats(self):
+        conn = self._conn()
+        keys = conn.execute("SELECT COUNT(*) FROM rate_buckets").fetchone()[0]
+        in_flight = conn.execute("SELECT COUNT(*) FROM rate_slots WHERE expires_at > ?", (time.time(),)).fetchone()[0]
+        return {"backend": "sqlite", "keys": keys, "in_flight": in_flight,
+                "allowed": self.allowed, "limited": self.limited}
+
+
+def make_rate_limiter(backend, basedir):
+    """Создает бэкенд по значению RATE_LIMIT: memory (по умолчанию), sqlite или off."""
+    if backend == 'memory':
+        return MemoryRateLimiter()
+    if backend == 'sqlite':
+        path = os.environ.get('RATE_LIMIT_PATH', os.path.join(basedir, 'rate_limit.db'))
+        return SQLiteRateLimiter(path, slot_ttl=float(os.environ.get('RATE_LIMIT_SLOT_TTL', 600)))
+    if backend not in ('', 'off'):
+        print(f"ОШИБКА: Неизвестный RATE_LIMIT='{backend}', ограничение частоты выключено")
+    return None
@@ -0,0 +1,148 @@
+# response_cache.py
+# Кэш ответов для детерминированных запросов к /v1/chat/completions.
+# Кэшируем только запросы с temperature=0 или с явным "cache": true в теле запроса.
+# Бэкенды: в памяти процесса (LRU) или в отдельном файле SQLite (общий для всех воркеров).
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Параметры, которые влияют на ответ модели и поэтому входят в ключ кэша
+SAMPLING_PARAMS = ('temperature', 'top_p', 'max_tokens', 'stop', 'presence_penalty',
+                   'frequency_penalty', 'seed', 'n', 'response_format', 'tools', 'tool_choice')
+
+
+def is_cacheable(request_data):
+    explicit = request_data.get('cache')
+    if explicit is not None:
+        return bool(explicit)
+    return request_data.get('temperature') == 0
+
+def sampling_params(request_data):
+    return {name: request_data[name] for name in SAMPLING_PARAMS if name in request_data}
+
+def cache_key(model_id, model_config, messages, request_data):
+    """Канонический хэш запроса: алиас и настоящие модели, сообщения и параметры семплирования."""
+    params = sampling_params(request_data)
+    real_models = sorted({backend.get("real_model") for backend in model_config.get("backends", [])})
+    canonical = json.dumps({"model": model_id, "real_models": real_models,
+                            "messages": messages, "params": params},
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_entries=1000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "hits": self.hits, "misses": self.misses, "size": len(self._data)}
+
+
+class SQLiteCacheBackend:
+    # Проверять размер таблицы на каждой записи дорого, поэтому вытесняем раз в N вставок
+    EVICT_EVERY = 50
+
+    def __init__(self, path, max_entries=10000, ttl=3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS completion_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_completion_cache_accessed ON completion_cache (accessed_at)")
+        conn.commit()
+
+    def _conn(self):
+        # Отдельное соединение на поток: sqlite3.Connection нельзя делить между потоками
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._conn()
+        now = time.time()
+        row = conn.execute("SELECT value FROM completion_cache WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        conn.execute("UPDATE completion_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        self.hits += 1
+        return row[0]
+
+    def set(self, key, value):
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO completion_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                     (key, value, now + self.ttl, now))
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            conn.execute("DELETE FROM completion_cache WHERE expires_at <= ?", (now,))
+            conn.execute("""
+                DELETE FROM completion_cache WHERE key IN (
+                    SELECT key FROM completion_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+        conn.commit()
+
+    def stats(self):
+        size = self._conn().execute("SELECT COUNT(*) FROM completion_cache").fetchone()[0]
+        return {"backend": "sqlite", "hits": self.hits, "misses": self.misses, "size": size}
+
+
+def make_cache(backend, basedir):
+    """Создает бэкенд по значению COMPLETION_CACHE: off (по умолчанию), memory или sqlite."""
+    max_entries = int(os.environ.get('COMPLETION_CACHE_SIZE', 1000))
+    ttl = float(os.environ.get('COMPLETION_CACHE_TTL', 3600))
+    if backend == 'memory':
+        return MemoryCacheBackend(max_entries=max_entries, ttl=ttl)
+    if backend == 'sqlite':
+        path = os.environ.get('COMPLETION_CACHE_PATH', os.path.join(basedir, 'completion_cache.db'))
+        return SQLiteCacheBackend(path, max_entries=max_entries, ttl=ttl)
+    if backend not in ('', 'off'):
+        print(f"ОШИБКА: Неизвестный COMPLETION_CACHE='{backend}', кэш ответов выключен")
+    return None
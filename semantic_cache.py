@@ -0,0 +1,266 @@
+# semantic_cache.py
+# Семантический кэш ответов: похожий (а не только дословно совпадающий) вопрос получает
+# ответ из кэша. Последний вопрос пользователя превращается в вектор хэширующим векторизатором
+# (слова + триграммы символов, без внешних моделей), вся предыдущая переписка, включая
+# системный промпт, должна совпасть точно. Поиск - перебор всех векторов (NumPy) или LSH.
+# NumPy необязателен: без него работает перебор на чистом Python (годится для небольших кэшей).
+import os
+import re
+import math
+import time
+import zlib
+import json
+import hashlib
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # необязательная зависимость
+    np = None
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Числа в вопросе должны совпасть точно: "1000003" и "1000033" почти не различаются для векторизатора
+_NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+# Вес триграмм ниже, чем у целых слов: они нужны, чтобы "тариф" и "тарифы" считались близкими
+TRIGRAM_WEIGHT = 0.5
+# Сходство, при котором новый ответ заменяет запись в индексе, а не добавляется рядом (тот же вопрос)
+DUPLICATE_SCORE = 0.9999
+
+
+class HashingVectorizer:
+    """Текст -> L2-нормированный вектор размерности dim (hashing trick со знаком)."""
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    def features(self, text):
+        weights = {}
+        for word in _WORD_RE.findall(text.lower()):
+            self._add(weights, word, 1.0)
+            padded = f"<{word}>"
+            for i in range(len(padded) - 2):
+                self._add(weights, padded[i:i + 3], TRIGRAM_WEIGHT)
+        norm = math.sqrt(sum(value * value for value in weights.values()))
+        return {index: value / norm for index, value in weights.items()} if norm else {}
+
+    def _add(self, weights, feature, weight):
+        # crc32, а не hash(): значение не должно зависеть от PYTHONHASHSEED, иначе у воркеров разные векторы
+        h = zlib.crc32(feature.encode('utf-8'))
+        index = h % self.dim
+        weights[index] = weights.get(index, 0.0) + (weight if h & 0x80000000 else -weight)
+
+    def embed(self, text):
+        features = self.features(text)
+        if np is None:
+            return features
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if features:
+            vector[list(features)] = list(features.values())
+        return vector
+
+
+def _dot(a, b):
+    # Скалярное произведение разреженных векторов (вариант без NumPy)
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(value * b.get(index, 0.0) for index, value in a.items())
+
+
+class _Entry:
+    __slots__ = ('prefix', 'vector', 'text', 'expires_at', 'used_at', 'buckets')
+
+    def __init__(self, prefix, vector, text, expires_at, now):
+        self.prefix = prefix
+        self.vector = vector
+        self.text = text
+        self.expires_at = expires_at
+        self.used_at = now
+        self.buckets = ()
+
+
+class VectorIndex:
+    """Векторы одного алиаса. Поиск перебором; при lsh_bits > 0 (нужен NumPy) кандидаты
+    берутся из корзин LSH по случайным гиперплоскостям, точное сходство считается только для них."""
+
+    def __init__(self, dim, max_entries=1000, ttl=3600, lsh_bits=0, lsh_tables=4, seed=0):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lsh_bits = lsh_bits if np is not None else 0
+        self._entries = {}  # slot -> _Entry
+        self._free = list(range(max_entries - 1, -1, -1))
+        self._matrix = np.zeros((max_entries, dim), dtype=np.float32) if np is not None else None
+        self._tables = []
+        if self.lsh_bits:
+            rng = np.random.default_rng(seed)
+            self._planes = [rng.standard_normal((self.lsh_bits, dim)).astype(np.float32) for _ in range(lsh_tables)]
+            self._tables = [{} for _ in range(lsh_tables)]
+            self._weights = 1 << np.arange(self.lsh_bits, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _signatures(self, vector):
+        return [int(((planes @ vector) > 0).astype(np.int64) @ self._weights) for planes in self._planes]
+
+    def _candidates(self, vector, prefix):
+        if not self._tables:
+            return list(self._entries)
+        slots = set()
+        for table, signature in zip(self._tables, self._signatures(vector)):
+            slots.update(table.get((prefix, signature), ()))
+        return list(slots)
+
+    def search(self, vector, prefix, now):
+        """Лучшее совпадение с тем же префиксом: (сходство, slot) или (None, None)."""
+        slots = [slot for slot in self._candidates(vector, prefix)
+                 if self._entries[slot].prefix == prefix and self._entries[slot].expires_at > now]
+        if not slots:
+            return None, None
+        if self._matrix is not None:
+            scores = self._matrix[slots] @ vector
+            best = int(scores.argmax())
+            return float(scores[best]), slots[best]
+        return max((_dot(self._entries[slot].vector, vector), slot) for slot in slots)
+
+    def get(self, slot, now):
+        entry = self._entries[slot]
+        entry.used_at = now
+        return entry.text
+
+    def add(self, vector, prefix, text, now):
+        # Ответ на тот же вопрос уже есть (например, его записали все запросы, ждавшие одного ответа
+        # провайдера) - обновляем запись, иначе дубликаты вытеснят из индекса другие вопросы
+        score, slot = self.search(vector, prefix, now)
+        if score is not None and score >= DUPLICATE_SCORE:
+            entry = self._entries[slot]
+            entry.text = text
+            entry.expires_at = now + self.ttl
+            entry.used_at = now
+            return slot
+        if not self._free:
+            self._evict(now)
+        slot = self._free.pop()
+        entry = self._entries[slot] = _Entry(prefix, vector, text, now + self.ttl, now)
+        if self._matrix is not None:
+            self._matrix[slot] = vector
+        if self._tables:
+            entry.buckets = [(prefix, signature) for signature in self._signatures(vector)]
+            for table, bucket in zip(self._tables, entry.buckets):
+                table.setdefault(bucket, set()).add(slot)
+        return slot
+
+    def _evict(self, now):
+        # Сначала все просроченные, если таких нет - давно не использованная запись
+        expired = [slot for slot, entry in self._entries.items() if entry.expires_at <= now]
+        for slot in expired or [min(self._entries, key=lambda slot: self._entries[slot].used_at)]:
+            self._remove(slot)
+
+    def _remove(self, slot):
+        entry = self._entries.pop(slot)
+        for table, bucket in zip(self._tables, entry.buckets):
+            members = table.get(bucket)
+            members.discard(slot)
+            if not members:
+                del table[bucket]
+        self._free.append(slot)
+
+
+def _message_text(message):
+    content = message.get('content')
+    if isinstance(content, list):
+        return " ".join(part.get('text', '') for part in content if isinstance(part, dict) and part.get('type') == 'text')
+    return content if isinstance(content, str) else ''
+
+
+class SemanticCache:
+    def __init__(self, thresholds, default_threshold=None, dim=1024, max_entries=1000, ttl=3600,
+                 lsh_bits=0, lsh_tables=4):
+        # thresholds - {алиас: порог сходства}; default_threshold - для остальных алиасов (None - выключено)
+        self.thresholds = thresholds
+        self.default_threshold = default_threshold
+        self.vectorizer = HashingVectorizer(dim)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lsh_bits = lsh_bits
+        self.lsh_tables = lsh_tables
+        self.hits = {}
+        self.misses = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def threshold(self, alias):
+        return self.thresholds.get(alias, self.default_threshold)
+
+    def probe(self, alias, messages, params=None):
+        """Вектор последнего вопроса и хэш всего, что должно совпасть точно: предыдущей переписки,
+        параметров семплирования (params) и чисел из вопроса. None - запрос не кэшируется."""
+        threshold = self.threshold(alias)
+        if not threshold or not messages or messages[-1].get('role') != 'user':
+            return None
+        question = _message_text(messages[-1])
+        if not question.strip():
+            return None
+        context = json.dumps({"messages": messages[:-1], "params": params or {}, "numbers": _NUMBER_RE.findall(question)},
+                             sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        prefix = hashlib.blake2b(context.encode('utf-8'), digest_size=16).hexdigest()
+        return {"alias": alias, "threshold": threshold, "prefix": prefix, "vector": self.vectorizer.embed(question)}
+
+    def _index(self, alias):
+        index = self._indexes.get(alias)
+        if index is None:
+            index = self._indexes[alias] = VectorIndex(self.vectorizer.dim, self.max_entries, self.ttl,
+                                                       self.lsh_bits, self.lsh_tables)
+        return index
+
+    def get(self, probe):
+        """(текст ответа, сходство) или (None, лучшее сходство ниже порога)."""
+        alias = probe["alias"]
+        now = time.time()
+        with self._lock:
+            index = self._index(alias)
+            score, slot = index.search(probe["vector"], probe["prefix"], now)
+            if score is not None and score >= probe["threshold"]:
+                self.hits[alias] = self.hits.get(alias, 0) + 1
+                return index.get(slot, now), score
+            self.misses[alias] = self.misses.get(alias, 0) + 1
+            return None, score
+
+    def set(self, probe, text):
+        with self._lock:
+            self._index(probe["alias"]).add(probe["vector"], probe["prefix"], text, time.time())
+
+    def stats(self):
+        with self._lock:
+            return {alias: {"size": len(index), "hits": self.hits.get(alias, 0), "misses": self.misses.get(alias, 0)}
+                    for alias, index in self._indexes.items()}
+
+
+def parse_thresholds(value):
+    """'alias=0.95,other=0.9' -> {'alias': 0.95, 'other': 0.9}; 'alias=off' выключает алиас."""
+    thresholds = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        alias, _, threshold = item.partition('=')
+        thresholds[alias.strip()] = None if threshold.strip() in ('', 'off', '0') else float(threshold)
+    return thresholds
+
+
+def make_semantic_cache(mode):
+    """Создает кэш по значению SEMANTIC_CACHE: off (по умолчанию), bruteforce или lsh."""
+    if mode in ('', 'off'):
+        return None
+    if mode not in ('bruteforce', 'lsh'):
+        print(f"ОШИБКА: Неизвестный SEMANTIC_CACHE='{mode}', семантический кэш выключен")
+        return None
+    if mode == 'lsh' and np is None:
+        print("ВНИМАНИЕ: Для SEMANTIC_CACHE=lsh нужен numpy, используется перебор")
+    # Векторизатор учитывает только набор слов: длинные вопросы, отличающиеся одним важным словом
+    # ("четных" / "нечетных"), дают сходство около 0.97, поэтому порог по умолчанию высокий
+    default = os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.98')
+    return SemanticCache(parse_thresholds(os.environ.get('SEMANTIC_CACHE_THRESHOLDS', '')),
+                         default_threshold=float(default) if default not in ('', 'off', '0') else None,
+                         dim=int(os.environ.get('SEMANTIC_CACHE_DIM', 1024)),
+                         max_entries=int(os.environ.get('SEMANTIC_CACHE_SIZE', 1000)),
+                         ttl=float(os.environ.get('SEMANTIC_CACHE_TTL', 3600)),
+                         lsh_bits=int(os.environ.get('SEMANTIC_CACHE_LSH_BITS', 12)) if mode == 'lsh' else 0,
+                         lsh_tables=int(os.environ.get('SEMANTIC_CACHE_LSH_TABLES', 4)))
@@ -0,0 +1,199 @@
+# singleflight.py
+# Объединение одинаковых запросов, которые выполняются одновременно (single-flight).
+# Первый запрос с данным ключом ("лидер") идет к провайдеру, остальные ("ведомые")
+# ждут его результат. Для потоков ответ раздается всем подписчикам по мере поступления.
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Broadcast:
+    """Общий поток кусочков ответа. Источник читает тот подписчик, который первым дошел
+    до конца буфера, остальные берут уже прочитанное из буфера - отдельный поток не нужен.
+    Когда отписывается последний подписчик, источник закрывается (отмена запроса к провайдеру)."""
+
+    def __init__(self, on_finish):
+        self.opened = threading.Event()
+        self.open_error = None
+        self.source = None
+        self.close_source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.pulling = False
+        self.abandoned = False
+        self.subscribers = 0
+        self._cond = threading.Condition()
+        self._on_finish = on_finish
+
+    def subscribe(self):
+        """Возвращает подписку или None, если поток уже брошен всеми подписчиками."""
+        with self._cond:
+            if self.abandoned:
+                return None
+            self.subscribers += 1
+        return _Subscription(self)
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+            abandoned = self.subscribers == 0 and not self.done
+            if abandoned:
+                self.abandoned = True
+                self._finish()
+        if abandoned:
+            self._on_finish(self)
+            # Все клиенты отключились - прекращаем генерацию у провайдера
+            if self.source is not None:
+                self.source.close()
+                self.close_source()
+
+    def _finish(self, error=None):
+        # Вызывается под self._cond; _on_finish - уже после его освобождения
+        self.done = True
+        self.error = error
+        self.pulling = False
+        self._cond.notify_all()
+
+    def iterate(self):
+        index = 0
+        while True:
+            pull = False
+            with self._cond:
+                while index >= len(self.chunks) and not self.done and self.pulling:
+                    self._cond.wait()
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    index += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    self.pulling = pull = True
+            if pull:
+                try:
+                    chunk = next(self.source)
+                except StopIteration:
+                    with self._cond:
+                        self._finish()
+                    self._on_finish(self)
+                    continue
+                except Exception as e:
+                    with self._cond:
+                        self._finish(e)
+                    self._on_finish(self)
+                    raise
+                with self._cond:
+                    self.chunks.append(chunk)
+                    self.pulling = False
+                    self._cond.notify_all()
+                index += 1
+            yield chunk
+
+
+class _Subscription:
+    """Итератор одного подписчика. close() обязателен: он снимает подписку,
+    даже если итерация так и не началась (клиент отключился раньше)."""
+
+    def __init__(self, broadcast):
+        self._broadcast = broadcast
+        self._chunks = broadcast.iterate()
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._chunks)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._chunks.close()
+        self._broadcast.unsubscribe()
+
+
+class SingleFlight:
+    def __init__(self):
+        self.leaders = 0
+        self.shared = 0
+        self._calls = {}
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Выполняет fn() один раз на все одновременные вызовы с одинаковым key."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stream(self, key, open_fn):
+        """Потоковый вариант. open_fn() открывает поток и возвращает (итератор кусочков, функция закрытия).
+        Ошибки открытия пробрасываются всем ожидающим. key=None - без объединения.
+        Возвращает итератор кусочков для текущего вызывающего."""
+        with self._lock:
+            broadcast = self._streams.get(key) if key is not None else None
+            # Подписываемся сразу, чтобы последний ушедший подписчик не закрыл поток раньше времени
+            subscription = broadcast.subscribe() if broadcast is not None else None
+            leader = subscription is None
+            if leader:
+                broadcast = _Broadcast(on_finish=lambda b: self._forget(key, b))
+                if key is not None:
+                    self._streams[key] = broadcast
+                subscription = broadcast.subscribe()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                broadcast.source, broadcast.close_source = open_fn()
+            except Exception as e:
+                broadcast.open_error = e
+                self._forget(key, broadcast)
+                raise
+            finally:
+                broadcast.opened.set()
+        else:
+            broadcast.opened.wait()
+            if broadcast.open_error is not None:
+                raise broadcast.open_error
+        return subscription
+
+    def _forget(self, key, broadcast):
+        if key is None:
+            return
+        with self._lock:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "shared": self.shared,
+                    "in_flight": len(self._calls) + len(self._streams)}
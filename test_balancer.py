@@ -0,0 +1,84 @@
+# test_balancer.py
+# Проверки circuit breaker'а BackendPool: python -m pytest -q
+import time
+import random
+
+import pytest
+import requests
+
+import balancer
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} error", response=response)
+
+
+def _open_circuit(backend):
+    backend.failures = balancer.CIRCUIT_FAILURE_THRESHOLD
+    backend.open_until = time.monotonic() - 1
+
+
+def _fail(status):
+    def call(config):
+        raise _http_error(status)
+    return call
+
+
+def test_half_open_probe_with_client_error_keeps_backend_in_rotation():
+    pool = balancer.BackendPool('test', [{"provider": "openai", "provider_url": "http://a/v1", "api_key": "k"}])
+    backend = pool.backends[0]
+    _open_circuit(backend)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        pool.call(_fail(400))
+
+    assert not backend.half_open
+    assert backend.available(time.monotonic() + 1000)
+
+
+def test_half_open_probe_success_closes_circuit():
+    pool = balancer.BackendPool('test', [{"provider": "openai", "provider_url": "http://a/v1", "api_key": "k"}])
+    backend = pool.backends[0]
+    _open_circuit(backend)
+
+    assert pool.call(lambda config: "ok") == (backend, "ok")
+    assert backend.failures == 0 and not backend.half_open
+
+
+def test_half_open_probe_failure_reopens_circuit(monkeypatch):
+    monkeypatch.setattr(balancer, 'MAX_ATTEMPTS', 1)
+    pool = balancer.BackendPool('test', [{"provider": "openai", "provider_url": "http://a/v1", "api_key": "k"}])
+    backend = pool.backends[0]
+    _open_circuit(backend)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        pool.call(_fail(503))
+
+    assert not backend.half_open
+    assert not backend.available(time.monotonic())
+    assert backend.available(backend.open_until + 1)
+
+
+def test_available_has_no_side_effects():
+    backend = balancer.Backend({"provider": "openai", "provider_url": "http://a/v1", "api_key": "k"}, 0)
+    _open_circuit(backend)
+
+    assert backend.available(time.monotonic())
+    assert not backend.half_open
+    assert backend.available(time.monotonic())
+
+
+def test_recovered_backend_gets_traffic_next_to_healthy_sibling():
+    for seed in range(50):
+        random.seed(seed)
+        pool = balancer.BackendPool('test', [{"provider": "openai", "provider_url": "http://a/v1", "api_key": "a"},
+                                             {"provider": "openai", "provider_url": "http://b/v1", "api_key": "b"}])
+        recovered = pool.backends[0]
+        _open_circuit(recovered)
+
+        picked = [pool.call(lambda config: config["api_key"])[1] for _ in range(500)]
+
+        assert picked.count("a") > 0, f"seed {seed}"
+        assert not recovered.half_open and recovered.failures == 0
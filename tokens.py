@@ -0,0 +1,85 @@
+# tokens.py
+# Быстрый локальный подсчет токенов для учета и предварительной проверки лимитов.
+# Если установлен tiktoken - для моделей OpenAI считаем точно, иначе используем
+# эвристику (слова и знаки препинания, длинные слова дробятся). Результаты кэшируются
+# по хэшу текста: длинные системные промпты Open WebUI повторяются в каждом запросе.
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import tiktoken
+except ImportError:  # необязательная зависимость
+    tiktoken = None
+
+# Служебные токены на каждое сообщение и на начало ответа (формула из OpenAI cookbook)
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+_encodings = {}
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+CACHE_SIZE = 4096
+
+
+def model_family(backend_config):
+    """Семейство токенизатора для бэкенда: 'openai' (tiktoken) или 'generic'."""
+    if backend_config.get("provider") == "openai" and backend_config.get("real_model", "").startswith("gpt"):
+        return "openai"
+    return "generic"
+
+def _encoding(family):
+    if tiktoken is None or family != "openai":
+        return None
+    encoding = _encodings.get(family)
+    if encoding is None:
+        try:
+            encoding = _encodings[family] = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # Например, нет доступа в интернет для загрузки словаря - остаемся на эвристике
+            print(f"ОШИБКА: Не удалось загрузить словарь tiktoken, используем оценку: {e}")
+            encoding = _encodings[family] = False
+    return encoding or None
+
+def _estimate(text):
+    count = 0
+    for word in _WORD_RE.findall(text):
+        if word.isascii():
+            # Английские слова - примерно 1 токен на 6 символов
+            count += 1 + (len(word) - 1) // 6
+        else:
+            # Кириллица и прочее дробится мельче - примерно 3 символа на токен
+            count += 1 + len(word) // 3
+    return count
+
+def count_text(text, family="generic"):
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    key = (family, digest)
+    with _cache_lock:
+        cached = _cache.get(key)
+        if cached is not None:
+            _cache.move_to_end(key)
+            return cached
+    encoding = _encoding(family)
+    count = len(encoding.encode(text, disallowed_special=())) if encoding else _estimate(text)
+    with _cache_lock:
+        _cache[key] = count
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return count
+
+def count_messages(messages, family="generic"):
+    total = TOKENS_PER_REPLY
+    for message in messages or []:
+        content = message.get("content")
+        if isinstance(content, list):
+            # Мультимодальные сообщения: считаем только текстовые части
+            content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+        total += TOKENS_PER_MESSAGE + count_text(content, family)
+    return total
@@ -0,0 +1,137 @@
+# upstream.py
+# Слой вызова настоящих провайдеров (OpenAI / Groq / Gemini).
+# Для каждого провайдера держим свой requests.Session с пулом keep-alive соединений,
+# чтобы не открывать новое TLS-соединение на каждый запрос.
+import os
+import json
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- НАСТРОЙКИ ПУЛА (через переменные окружения) ---
+# Сколько соединений держать открытыми к одному провайдеру
+POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 100))
+# Таймауты в секундах: на установку соединения и на ожидание данных от модели
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 120))
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _pool_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def get_session(url):
+    """Возвращает общий Session для хоста провайдера (создается один раз на процесс)."""
+    key = _pool_key(url)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+    return session
+
+def post(url, **kwargs):
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return get_session(url).post(url, **kwargs)
+
+def close_all():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+# --- ВЫЗОВ ПРОВАЙДЕРОВ ---
+def _provider_headers(model_config):
+    return {'Authorization': f'Bearer {model_config["api_key"]}', 'Content-Type': 'application/json'}
+
+def _google_payload(messages):
+    return {"contents": [{"parts": [{"text": msg["content"]}] for msg in messages if msg['role'] == 'user'}]}
+
+def _google_stream_url(provider_url):
+    # generateContent -> streamGenerateContent, alt=sse отдает ответ в формате Server-Sent Events
+    url = provider_url.replace(':generateContent', ':streamGenerateContent')
+    return url + ('&' if '?' in url else '?') + 'alt=sse'
+
+def _openai_usage(usage):
+    if not usage:
+        return None
+    return {"prompt_tokens": usage.get("prompt_tokens", 0), "completion_tokens": usage.get("completion_tokens", 0)}
+
+def _google_usage(usage):
+    if not usage:
+        return None
+    return {"prompt_tokens": usage.get("promptTokenCount", 0), "completion_tokens": usage.get("candidatesTokenCount", 0)}
+
+def call_provider(model_config, messages):
+    """Обычный (не потоковый) запрос к провайдеру.
+    Возвращает (текст ответа, usage), где usage - {"prompt_tokens", "completion_tokens"} или None."""
+    headers = _provider_headers(model_config)
+    if model_config["provider"] == "google":
+        response = post(model_config["provider_url"], headers=headers, json=_google_payload(messages))
+        response.raise_for_status()
+        data = response.json()
+        return data["candidates"][0]["content"]["parts"][0]["text"], _google_usage(data.get("usageMetadata"))
+    # provider == "openai"
+    payload = {"model": model_config["real_model"], "messages": messages}
+    response = post(model_config["provider_url"], headers=headers, json=payload)
+    response.raise_for_status()
+    data = response.json()
+    return data["choices"][0]["message"]["content"], _openai_usage(data.get("usage"))
+
+def open_provider_stream(model_config, messages):
+    """Открывает потоковый запрос к провайдеру. Возвращает открытый requests.Response (stream=True)."""
+    headers = _provider_headers(model_config)
+    if model_config["provider"] == "google":
+        response = post(_google_stream_url(model_config["provider_url"]), headers=headers,
+                        json=_google_payload(messages), stream=True)
+    else: # provider == "openai"
+        payload = {"model": model_config["real_model"], "messages": messages, "stream": True}
+        if model_config.get("stream_usage", True):
+            # Попросить провайдера прислать usage последним чанком
+            payload["stream_options"] = {"include_usage": True}
+        response = post(model_config["provider_url"], headers=headers, json=payload, stream=True)
+    try:
+        response.raise_for_status()
+    except requests.exceptions.RequestException:
+        response.close()
+        raise
+    return response
+
+def iter_provider_stream(model_config, response):
+    """Читает SSE-поток провайдера и отдает кусочки текста (str) по мере их прихода.
+    Последним элементом может прийти usage (dict), если провайдер его прислал."""
+    usage = None
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        event = json.loads(data)
+        if model_config["provider"] == "google":
+            # streamGenerateContent: каждый event - это GenerateContentResponse,
+            # usageMetadata в последнем из них - итог по всему ответу
+            candidates = event.get("candidates") or []
+            parts = candidates[0].get("content", {}).get("parts", []) if candidates else []
+            text = "".join(part.get("text", "") for part in parts)
+            usage = _google_usage(event.get("usageMetadata")) or usage
+        else:
+            # OpenAI / Groq: chat.completion.chunk (Groq кладет usage в x_groq)
+            choices = event.get("choices") or []
+            text = (choices[0].get("delta") or {}).get("content") if choices else None
+            usage = _openai_usage(event.get("usage") or (event.get("x_groq") or {}).get("usage")) or usage
+        if text:
+            yield text
+    if usage:
+        yield usage
@@ -0,0 +1,120 @@
+# usage.py
+# Учет использованных сообщений и токенов в памяти с отложенной (пакетной) записью в БД.
+# Вместо UPDATE + commit на каждый запрос копим приращения по api_key
+# и раз в несколько секунд записываем их одной транзакцией.
+import atexit
+import threading
+
+
+class UsageAccumulator:
+    def __init__(self, flush_fn, interval=2.0, max_pending=500, on_flushed=None):
+        # flush_fn(increments) - получает {api_key: (сообщения, токены)} и пишет в БД одной транзакцией
+        # on_flushed(api_key, messages, tokens) - вызывается под блокировкой, когда приращение ушло в БД,
+        # чтобы перенести его в снимок пользователя (message_count/token_count из auth_cache)
+        self.flush_fn = flush_fn
+        self.interval = interval
+        self.max_pending = max_pending
+        self.on_flushed = on_flushed
+        self.flushes = 0
+        self.flushed_rows = 0
+        self._pending = {}  # api_key -> [сообщения, токены]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def used(self, user):
+        """(сообщений, токенов) с учетом еще не записанного в БД."""
+        with self._lock:
+            messages, tokens = self._pending.get(user.api_key, (0, 0))
+            return user.message_count + messages, user.token_count + tokens
+
+    def reserve(self, user, tokens=0):
+        """Атомарно проверяет лимиты и резервирует одно сообщение и tokens токенов.
+        Возвращает None, если резерв сделан, иначе причину отказа:
+        'message_limit', 'token_limit' (токены закончились) или 'token_budget' (запрос больше остатка)."""
+        self._ensure_started()
+        with self._lock:
+            pending = self._pending.get(user.api_key) or [0, 0]
+            if user.message_count + pending[0] >= user.message_limit:
+                return 'message_limit'
+            used_tokens = user.token_count + pending[1]
+            if used_tokens >= user.token_limit:
+                return 'token_limit'
+            if used_tokens + tokens > user.token_limit:
+                return 'token_budget'
+            self._pending[user.api_key] = [pending[0] + 1, pending[1] + tokens]
+            if len(self._pending) >= self.max_pending:
+                self._wake.set()
+        return None
+
+    def _add(self, user, messages, tokens):
+        with self._lock:
+            # Резерв мог уже уйти в БД - тогда здесь получится отрицательное приращение
+            pending = self._pending.setdefault(user.api_key, [0, 0])
+            pending[0] += messages
+            pending[1] += tokens
+
+    def release(self, user, tokens=0):
+        """Возвращает резерв, если запрос к модели не удался."""
+        self._add(user, -1, -tokens)
+
+    def settle(self, user, reserved_tokens, actual_tokens):
+        """Заменяет оценку токенов, сделанную при резерве, на фактический расход."""
+        if actual_tokens != reserved_tokens:
+            self._add(user, 0, actual_tokens - reserved_tokens)
+
+    def flush(self):
+        # _flush_lock: фоновый поток и atexit не должны писать одну пачку дважды
+        with self._flush_lock:
+            with self._lock:
+                batch = {key: tuple(delta) for key, delta in self._pending.items() if any(delta)}
+                self._pending = {}
+                self._apply(batch, 1)
+            if not batch:
+                return
+            try:
+                self.flush_fn(batch)
+            except Exception as e:
+                print(f"ОШИБКА: Не удалось записать счетчики использования в БД: {e}")
+                # Возвращаем приращения обратно, попробуем в следующий раз
+                with self._lock:
+                    for key, (messages, tokens) in batch.items():
+                        pending = self._pending.setdefault(key, [0, 0])
+                        pending[0] += messages
+                        pending[1] += tokens
+                    self._apply(batch, -1)
+                return
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+
+    def _apply(self, batch, sign):
+        if self.on_flushed:
+            for key, (messages, tokens) in batch.items():
+                self.on_flushed(key, sign * messages, sign * tokens)
+
+    def _ensure_started(self):
+        if self._thread is not None or self._stopped:
+            return
+        with self._lock:
+            if self._thread is None:
+                # Поток создается при первом запросе, т.е. уже внутри воркера gunicorn (после fork)
+                self._thread = threading.Thread(target=self._run, name='usage-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {"pending_keys": len(self._pending), "flushes": self.flushes, "flushed_rows": self.flushed_rows}
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        self.flush()
@@ -0,0 +1,44 @@
+# web_ui.py
+# Личный кабинет: вход по API-ключу, профиль с расходом лимитов и выбором тарифа, выход.
+# Подключается, если в APP_COMPONENTS есть web (см. custom_provider.py).
+from flask import Blueprint, current_app, request, render_template, redirect, url_for, session
+
+from models import TARIFF_PLANS, User
+
+bp = Blueprint('web_ui', __name__)
+
+
+@bp.route('/login', methods=['GET', 'POST'])
+def login():
+    if request.method == 'POST':
+        api_key = request.form.get('api_key')
+        user = User.query.filter_by(api_key=api_key).first()
+        if user:
+            session['api_key'] = user.api_key # Запоминаем ключ в сессии
+            return redirect(url_for('web_ui.profile'))
+        else:
+            return render_template('login.html', error="Неверный API ключ")
+    return render_template('login.html')
+
+@bp.route('/profile')
+def profile():
+    if 'api_key' not in session:
+        return redirect(url_for('web_ui.login'))
+
+    user = User.query.filter_by(api_key=session['api_key']).first()
+    if not user:
+        session.clear() # Ключ недействителен, чистим сессию
+        return redirect(url_for('web_ui.login'))
+
+    # Кнопки оплаты показываем, только если оплата подключена (APP_COMPONENTS с billing)
+    return render_template('profile.html', user=user, plans=TARIFF_PLANS,
+                           billing_enabled='billing' in current_app.blueprints)
+
+@bp.route('/logout')
+def logout():
+    session.clear()
+    return redirect(url_for('web_ui.login'))
+
+
+def init_app(app):
+    app.register_blueprint(bp)